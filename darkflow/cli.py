@@ -24,6 +24,10 @@ def cliHandler(args):
     except: pass
 
     tfnet = TFNet(FLAGS)
+
+    if FLAGS.profile:
+        tfnet.framework.profile(tfnet)
+        exit('Profile finished, exit.')
     
     if FLAGS.demo:
         tfnet.camera()
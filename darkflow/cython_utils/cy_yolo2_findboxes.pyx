@@ -3,14 +3,18 @@ cimport numpy as np
 cimport cython
 ctypedef np.float_t DTYPE_t
 from libc.math cimport exp
-from ..utils.box import BoundBox
-from nms cimport NMS
+from ..utils.box import to_bound_boxes
+from nms cimport NMS_c
+from cython.parallel cimport prange
+
+#grid offsets and anchor sizes, relative to the image, per output layout
+cdef dict _tables = dict()
 
 #expit
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 @cython.cdivision(True)
-cdef float expit_c(float x):
+cdef float expit_c(float x) nogil:
     cdef float y= 1/(1+exp(-x))
     return y
 
@@ -18,7 +22,7 @@ cdef float expit_c(float x):
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 @cython.cdivision(True)
-cdef float max_c(float a, float b):
+cdef float max_c(float a, float b) nogil:
     if(a>b):
         return a
     return b
@@ -46,52 +50,131 @@ cdef void _softmax_c(float* x, int classes):
         
         
 
-#BOX CONSTRUCTOR
+#TABLES
+def _decode_tables(H, W, B, anchors):
+    key = (H, W, B, tuple(anchors))
+    tables = _tables.get(key)
+    if tables is None:
+        anchors = np.asarray(anchors, dtype=np.float32).reshape(B, 2)
+        tables = (
+            np.arange(W, dtype=np.float32) / W,
+            np.arange(H, dtype=np.float32) / H,
+            np.ascontiguousarray(anchors[:, 0] / W),
+            np.ascontiguousarray(anchors[:, 1] / H))
+        _tables[key] = tables
+    return tables
+
+#DECODE
 @cython.cdivision(True)
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-def box_constructor(meta,np.ndarray[float,ndim=3] net_out_in):
+cdef np.intp_t _decode(float[:, :, :, ::1] net_out, float threshold, int[::1] keep,
+                       float[::1] grid_x, float[::1] grid_y, float[::1] anchor_w, float[::1] anchor_h,
+                       float[:, ::1] probs, float[:, ::1] bbox) noexcept nogil:
+    """
+    Writes the anchors with at least one kept class score above
+    threshold as compact rows of probs and bbox, returns the number of
+    rows. Column k of probs is the score of class keep[k], normalized
+    over all classes. Class probabilities are at most 1, so an anchor
+    whose objectness is not above threshold is skipped before softmax
+    and geometry, and so is one whose best kept class is not above
+    threshold even with a softmax denominator of 1
+    """
     cdef:
-        np.intp_t H, W, _, C, B, row, col, box_loop, class_loop
-        np.intp_t row1, col1, box_loop1,index,index2
-        float  threshold = meta['thresh']
-        float tempc,arr_max=0,sum=0
-        double[:] anchors = np.asarray(meta['anchors'])
-        list boxes = list()
+        np.intp_t H = net_out.shape[0], W = net_out.shape[1], B = net_out.shape[2]
+        np.intp_t C = net_out.shape[3] - 5, K = keep.shape[0]
+        np.intp_t row, col, box_loop, class_loop, count = 0
+        float obj, arr_max, keep_max, sum, tempc
+        bint found
 
-    H, W, _ = meta['out_size']
-    C = meta['classes']
-    B = meta['num']
-    
-    cdef:
-        float[:, :, :, ::1] net_out = net_out_in.reshape([H, W, B, net_out_in.shape[2]/B])
-        float[:, :, :, ::1] Classes = net_out[:, :, :, 5:]
-        float[:, :, :, ::1] Bbox_pred =  net_out[:, :, :, :5]
-        float[:, :, :, ::1] probs = np.zeros((H, W, B, C), dtype=np.float32)
-    
     for row in range(H):
         for col in range(W):
             for box_loop in range(B):
-                arr_max=0
-                sum=0;
-                Bbox_pred[row, col, box_loop, 4] = expit_c(Bbox_pred[row, col, box_loop, 4])
-                Bbox_pred[row, col, box_loop, 0] = (col + expit_c(Bbox_pred[row, col, box_loop, 0])) / W
-                Bbox_pred[row, col, box_loop, 1] = (row + expit_c(Bbox_pred[row, col, box_loop, 1])) / H
-                Bbox_pred[row, col, box_loop, 2] = exp(Bbox_pred[row, col, box_loop, 2]) * anchors[2 * box_loop + 0] / W
-                Bbox_pred[row, col, box_loop, 3] = exp(Bbox_pred[row, col, box_loop, 3]) * anchors[2 * box_loop + 1] / H
-                #SOFTMAX BLOCK, no more pointer juggling
-                for class_loop in range(C):
-                    arr_max=max_c(arr_max,Classes[row,col,box_loop,class_loop])
-                
-                for class_loop in range(C):
-                    Classes[row,col,box_loop,class_loop]=exp(Classes[row,col,box_loop,class_loop]-arr_max)
-                    sum+=Classes[row,col,box_loop,class_loop]
-                
+                obj = expit_c(net_out[row, col, box_loop, 4])
+                if obj <= threshold: continue
+
+                #SOFTMAX BLOCK, scaled by the objectness
+                arr_max = net_out[row, col, box_loop, 5]
+                for class_loop in range(1, C):
+                    arr_max = max_c(arr_max, net_out[row, col, box_loop, 5 + class_loop])
+                keep_max = net_out[row, col, box_loop, 5 + keep[0]]
+                for class_loop in range(1, K):
+                    keep_max = max_c(keep_max, net_out[row, col, box_loop, 5 + keep[class_loop]])
+                if obj * exp(keep_max - arr_max) <= threshold: continue
+                sum = 0
                 for class_loop in range(C):
-                    tempc = Classes[row, col, box_loop, class_loop] * Bbox_pred[row, col, box_loop, 4]/sum                    
-                    if(tempc > threshold):
-                        probs[row, col, box_loop, class_loop] = tempc
-    
-    
-    #NMS                    
-    return NMS(np.ascontiguousarray(probs).reshape(H*W*B,C), np.ascontiguousarray(Bbox_pred).reshape(H*B*W,5))
+                    sum += exp(net_out[row, col, box_loop, 5 + class_loop] - arr_max)
+                found = False
+                for class_loop in range(K):
+                    tempc = exp(net_out[row, col, box_loop, 5 + keep[class_loop]] - arr_max) * obj / sum
+                    if tempc > threshold:
+                        probs[count, class_loop] = tempc
+                        found = True
+                    else:
+                        probs[count, class_loop] = 0
+                if not found: continue
+
+                bbox[count, 0] = grid_x[col] + expit_c(net_out[row, col, box_loop, 0]) / W
+                bbox[count, 1] = grid_y[row] + expit_c(net_out[row, col, box_loop, 1]) / H
+                bbox[count, 2] = exp(net_out[row, col, box_loop, 2]) * anchor_w[box_loop]
+                bbox[count, 3] = exp(net_out[row, col, box_loop, 3]) * anchor_h[box_loop]
+                bbox[count, 4] = obj
+                count += 1
+    return count
+
+#BOX CONSTRUCTOR
+def box_constructor_array(meta, np.ndarray[float,ndim=3] net_out_in):
+    return box_constructor_batch(meta, np.expand_dims(net_out_in, 0))[0]
+
+#BATCH BOX CONSTRUCTOR
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+def box_constructor_batch(meta, np.ndarray[float,ndim=4] net_out_in):
+    """
+    Decode and NMS of a whole (N, H, W, B*(5+C)) output batch, the
+    images in parallel without the GIL. Returns one (boxes, scores,
+    classes) tuple of arrays per image
+    """
+    cdef:
+        np.intp_t N = net_out_in.shape[0], H, W, _, C, B, K, i, count
+        float threshold = meta['thresh']
+        float nms_thresh = meta.get('nms', 0.4)
+        bint agnostic = meta.get('nms_agnostic', False)
+        np.intp_t top_k = meta.get('nms_top_k', 0)
+        np.ndarray keep_arr
+        list result = list()
+
+    H, W, _ = meta['out_size']
+    C = meta['classes']
+    B = meta['num']
+    grid_x, grid_y, anchor_w, anchor_h = _decode_tables(H, W, B, meta['anchors'])
+    keep_arr = np.asarray(meta.get('keep_classes') or range(C), dtype=np.int32)
+    K = len(keep_arr)
+
+    cdef:
+        float[:, :, :, :, ::1] net_out = np.ascontiguousarray(net_out_in).reshape([N, H, W, B, 5 + C])
+        int[::1] keep = keep_arr
+        float[::1] gx = grid_x, gy = grid_y, aw = anchor_w, ah = anchor_h
+        float[:, :, ::1] probs = np.empty((N, H*W*B, K), dtype=np.float32)
+        float[:, :, ::1] bbox = np.empty((N, H*W*B, 5), dtype=np.float32)
+        np.ndarray boxes_arr = np.empty((N, H*W*B, 5), dtype=np.float32)
+        np.ndarray scores_arr = np.empty((N, H*W*B), dtype=np.float32)
+        np.ndarray classes_arr = np.empty((N, H*W*B), dtype=np.int32)
+        float[:, :, ::1] boxes = boxes_arr
+        float[:, ::1] scores = scores_arr
+        int[:, ::1] classes = classes_arr
+        np.intp_t[::1] counts = np.empty(N, dtype=np.intp)
+
+    for i in prange(N, nogil=True, schedule='dynamic'):
+        count = _decode(net_out[i], threshold, keep, gx, gy, aw, ah, probs[i], bbox[i])
+        #NMS, only among the kept classes
+        counts[i] = NMS_c(probs[i, :count], bbox[i, :count], nms_thresh, agnostic, top_k, boxes[i], scores[i], classes[i])
+
+    for i in range(N):
+        count = counts[i]
+        result.append((boxes_arr[i, :count], scores_arr[i, :count], keep_arr[classes_arr[i, :count]]))
+    return result
+
+#BOX CONSTRUCTOR, BoundBox list for legacy callers
+def box_constructor(meta, net_out_in):
+    return to_bound_boxes(*box_constructor_array(meta, net_out_in), class_num=meta['classes'])
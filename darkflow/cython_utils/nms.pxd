@@ -3,9 +3,15 @@ cimport numpy as np
 cimport cython
 ctypedef np.float_t DTYPE_t
 from libc.math cimport exp
-from utils.box import BoundBox
 
 
-cdef NMS(float[:, ::1] , float[:, ::1] )
+cdef struct candidate:
+    float score
+    np.intp_t index
+    int cls
+
+cdef float box_iou_c(float, float, float, float, float, float, float, float) nogil
+cdef np.intp_t NMS_c(float[:, ::1] , float[:, ::1] , float, bint, np.intp_t, float[:, ::1], float[::1], int[::1]) noexcept nogil
+cdef tuple NMS(float[:, ::1] , float[:, ::1] , float, bint, np.intp_t)
 
 
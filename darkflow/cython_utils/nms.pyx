@@ -2,7 +2,7 @@ import numpy as np
 cimport numpy as np
 cimport cython
 from libc.math cimport exp
-from ..utils.box import BoundBox
+from libc.stdlib cimport malloc, calloc, free, qsort
 
 
 
@@ -10,7 +10,7 @@ from ..utils.box import BoundBox
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 @cython.cdivision(True)
-cdef float overlap_c(float x1, float w1 , float x2 , float w2):
+cdef float overlap_c(float x1, float w1 , float x2 , float w2) nogil:
     cdef:
         float l1,l2,left,right
     l1 = x1 - w1 /2.
@@ -25,7 +25,7 @@ cdef float overlap_c(float x1, float w1 , float x2 , float w2):
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 @cython.cdivision(True)
-cdef float box_intersection_c(float ax, float ay, float aw, float ah, float bx, float by, float bw, float bh):
+cdef float box_intersection_c(float ax, float ay, float aw, float ah, float bx, float by, float bw, float bh) nogil:
     cdef:
         float w,h,area
     w = overlap_c(ax, aw, bx, bw)
@@ -38,7 +38,7 @@ cdef float box_intersection_c(float ax, float ay, float aw, float ah, float bx,
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 @cython.cdivision(True)
-cdef float box_union_c(float ax, float ay, float aw, float ah, float bx, float by, float bw, float bh):
+cdef float box_union_c(float ax, float ay, float aw, float ah, float bx, float by, float bw, float bh) nogil:
     cdef:
         float i,u
     i = box_intersection_c(ax, ay, aw, ah, bx, by, bw, bh)
@@ -50,82 +50,120 @@ cdef float box_union_c(float ax, float ay, float aw, float ah, float bx, float b
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 @cython.cdivision(True)
-cdef float box_iou_c(float ax, float ay, float aw, float ah, float bx, float by, float bw, float bh):
+cdef float box_iou_c(float ax, float ay, float aw, float ah, float bx, float by, float bw, float bh) nogil:
     return box_intersection_c(ax, ay, aw, ah, bx, by, bw, bh) / box_union_c(ax, ay, aw, ah, bx, by, bw, bh);
 
 
 
 
+#CANDIDATE ORDER, best score first, lowest prediction index on ties
+cdef int _by_score(const void* a, const void* b) noexcept nogil:
+    cdef:
+        candidate* ca = <candidate*> a
+        candidate* cb = <candidate*> b
+    if ca.score > cb.score: return -1
+    if ca.score < cb.score: return 1
+    return (ca.index > cb.index) - (ca.index < cb.index)
+
 #NMS
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 @cython.cdivision(True)
-cdef NMS(float[:, ::1] final_probs , float[:, ::1] final_bbox):
-    cdef list boxes = list()
-    cdef set indices = set()
+cdef np.intp_t NMS_c(float[:, ::1] final_probs, float[:, ::1] final_bbox, float nms_thresh, bint agnostic, np.intp_t top_k,
+                     float[:, ::1] out_boxes, float[::1] out_scores, int[::1] out_classes) noexcept nogil:
+    """
+    Sparse NMS: the nonzero (prediction, class) scores are compacted,
+    sorted best first and cut to top_k (0 keeps all), then only those
+    candidates suppress each other. Writes one row per surviving
+    prediction, with its best surviving class, into the out arrays
+    (at least final_bbox.shape[0] rows) best score first and returns
+    the number of rows written
+    """
+    cdef:
+        np.intp_t pred_length = final_bbox.shape[0]
+        np.intp_t class_length = final_probs.shape[1]
+        np.intp_t index, index2, class_loop, i, j, count = 0, kept = 0
+        bint has_c = final_bbox.shape[1] > 4
+        float score, best
+        int best_class
+        candidate* cand
+        char* done
+
+    #COMPACT
+    for index in range(pred_length):
+        for class_loop in range(class_length):
+            if final_probs[index, class_loop] > 0:
+                count += 1
+                if agnostic: break
+    if count == 0: return 0
+
+    cand = <candidate*> malloc(count * sizeof(candidate))
+    done = <char*> calloc(pred_length, sizeof(char))
+    count = 0
+    for index in range(pred_length):
+        if agnostic:
+            #class-agnostic: every prediction only keeps its best class
+            best = 0
+            best_class = -1
+            for class_loop in range(class_length):
+                if final_probs[index, class_loop] > best:
+                    best = final_probs[index, class_loop]
+                    best_class = class_loop
+            if best_class < 0: continue
+            cand[count].score = best
+            cand[count].index = index
+            cand[count].cls = best_class
+            count += 1
+            continue
+        for class_loop in range(class_length):
+            score = final_probs[index, class_loop]
+            if score > 0:
+                cand[count].score = score
+                cand[count].index = index
+                cand[count].cls = class_loop
+                count += 1
+
+    #SORT
+    qsort(cand, count, sizeof(candidate), _by_score)
+    if top_k > 0 and count > top_k:
+        count = top_k
+
+    #SUPPRESS
+    for i in range(count):
+        if cand[i].index < 0: continue
+        index = cand[i].index
+        for j in range(i+1, count):
+            if cand[j].index < 0: continue
+            if not agnostic and cand[j].cls != cand[i].cls: continue
+            index2 = cand[j].index
+            if box_iou_c(final_bbox[index,0],final_bbox[index,1],final_bbox[index,2],final_bbox[index,3],final_bbox[index2,0],final_bbox[index2,1],final_bbox[index2,2],final_bbox[index2,3]) >= nms_thresh:
+                cand[j].index = -1
+
+        #first survivor of a prediction carries its best class
+        if done[index]: continue
+        done[index] = 1
+        out_boxes[kept, 0] = final_bbox[index, 0]
+        out_boxes[kept, 1] = final_bbox[index, 1]
+        out_boxes[kept, 2] = final_bbox[index, 2]
+        out_boxes[kept, 3] = final_bbox[index, 3]
+        out_boxes[kept, 4] = final_bbox[index, 4] if has_c else 0
+        out_scores[kept] = cand[i].score
+        out_classes[kept] = cand[i].cls
+        kept += 1
+
+    free(cand)
+    free(done)
+    return kept
+
+cdef tuple NMS(float[:, ::1] final_probs, float[:, ::1] final_bbox, float nms_thresh, bint agnostic, np.intp_t top_k):
+    """
+    NMS_c into fresh arrays: boxes (x, y, w, h, c) relative to
+    the image, best class score and best class index
+    """
     cdef:
-        np.intp_t pred_length,class_length,class_loop,index,index2
-
-  
-    pred_length = final_bbox.shape[0]
-    class_length = final_probs.shape[1]
-    for class_loop in range(class_length):
-        for index in range(pred_length):
-            if final_probs[index,class_loop] == 0: continue
-            for index2 in range(index+1,pred_length):
-                if final_probs[index2,class_loop] == 0: continue
-                if index==index2 : continue
-                if box_iou_c(final_bbox[index,0],final_bbox[index,1],final_bbox[index,2],final_bbox[index,3],final_bbox[index2,0],final_bbox[index2,1],final_bbox[index2,2],final_bbox[index2,3]) >= 0.4:
-                    if final_probs[index2,class_loop] > final_probs[index, class_loop] :
-                        final_probs[index, class_loop] =0
-                        break
-                    final_probs[index2,class_loop]=0
-            
-            if index not in indices:
-                bb=BoundBox(class_length)
-                bb.x = final_bbox[index, 0]
-                bb.y = final_bbox[index, 1]
-                bb.w = final_bbox[index, 2]
-                bb.h = final_bbox[index, 3]
-                bb.c = final_bbox[index, 4]
-                bb.probs = np.asarray(final_probs[index,:])
-                boxes.append(bb)
-                indices.add(index)
-    return boxes
-
-# cdef NMS(float[:, ::1] final_probs , float[:, ::1] final_bbox):
-#     cdef list boxes = list()
-#     cdef:
-#         np.intp_t pred_length,class_length,class_loop,index,index2, i, j
-
-  
-#     pred_length = final_bbox.shape[0]
-#     class_length = final_probs.shape[1]
-
-#     for class_loop in range(class_length):
-#         order = np.argsort(final_probs[:,class_loop])[::-1]
-#         # First box
-#         for i in range(pred_length):
-#             index = order[i]
-#             if final_probs[index, class_loop] == 0.: 
-#                 continue
-#             # Second box
-#             for j in range(i+1, pred_length):
-#                 index2 = order[j]
-#                 if box_iou_c(
-#                     final_bbox[index,0],final_bbox[index,1],
-#                     final_bbox[index,2],final_bbox[index,3],
-#                     final_bbox[index2,0],final_bbox[index2,1],
-#                     final_bbox[index2,2],final_bbox[index2,3]) >= 0.4:
-#                     final_probs[index2, class_loop] = 0.
-                    
-#             bb = BoundBox(class_length)
-#             bb.x = final_bbox[index, 0]
-#             bb.y = final_bbox[index, 1]
-#             bb.w = final_bbox[index, 2]
-#             bb.h = final_bbox[index, 3]
-#             bb.c = final_bbox[index, 4]
-#             bb.probs = np.asarray(final_probs[index,:])
-#             boxes.append(bb)
-  
-#     return boxes
+        np.intp_t pred_length = final_bbox.shape[0], kept
+        np.ndarray boxes = np.empty((pred_length, 5), dtype=np.float32)
+        np.ndarray scores = np.empty(pred_length, dtype=np.float32)
+        np.ndarray classes = np.empty(pred_length, dtype=np.int32)
+    kept = NMS_c(final_probs, final_bbox, nms_thresh, agnostic, top_k, boxes, scores, classes)
+    return boxes[:kept], scores[:kept], classes[:kept]
@@ -122,6 +122,9 @@ class conv_select_layer(Layer):
             self.w['moving_variance'] = np.take(v, idx)
             self.w['gamma'] = np.take(g, idx)
 
+    def fold_batchnorm(self):
+        convolutional_layer.fold_batchnorm(self)
+
 class convolutional_layer(Layer):
     def setup(self, ksize, c, n, stride, 
               pad, batch_norm, activation):
@@ -153,4 +156,20 @@ class convolutional_layer(Layer):
         if kernel is None: return
         kernel = kernel.reshape(self.dnshape)
         kernel = kernel.transpose([2,3,1,0])
-        self.w['kernel'] = kernel
\ No newline at end of file
+        self.w['kernel'] = kernel
+
+    def fold_batchnorm(self):
+        """
+        Merge the inference batch norm into kernel and biases,
+        (conv - mean) / (sqrt(var) + 1e-5) * gamma + biases
+        as in ops.convolutional.batchnorm, and drop it
+        """
+        if not self.batch_norm: return
+        w = self.w
+        scale = w['gamma'] / (np.sqrt(w['moving_variance']) + 1e-5)
+        w['kernel'] = (w['kernel'] * scale).astype(np.float32)
+        w['biases'] = (w['biases'] - w['moving_mean'] * scale).astype(np.float32)
+        for var in ['moving_variance', 'moving_mean', 'gamma']:
+            del w[var], self.wshape[var], self.wsize[var]
+        self.h.pop('is_training', None)
+        self.batch_norm = False
\ No newline at end of file
@@ -15,6 +15,11 @@ class argHandler(dict):
         self.define('summary', '', 'path to TensorBoard summaries directory')
         self.define('annotation', '../pascal/VOCdevkit/ANN/', 'path to annotation directory')
         self.define('threshold', -0.1, 'detection threshold')
+        self.define('nms', 0.4, 'IoU threshold of the non-maximum suppression')
+        self.define('nmsAgnostic', False, 'let boxes of different classes suppress each other')
+        self.define('nmsTopK', 0, 'only the best scoring candidates enter the non-maximum suppression, 0 for all')
+        self.define('keepLabels', '', 'comma separated labels to keep, all when empty')
+        self.define('maxDet', 0, 'keep at most this many detections per image, 0 for no limit')
         self.define('model', '', 'configuration of choice')
         self.define('trainer', 'rmsprop', 'training algorithm')
         self.define('momentum', 0.0, 'applicable for rmsprop and momentum optimizers')
@@ -22,6 +27,9 @@ class argHandler(dict):
         self.define('train', False, 'train the whole net')
         self.define('load', '', 'how to initialize the net? Either from .weights or a checkpoint, or even from scratch')
         self.define('savepb', False, 'save net and weight to a .pb file')
+        self.define('savepbOptimize', False, 'with savepb, fold batch norms into the convolutions and strip training-only nodes')
+        self.define('savepbPrecision', 'float32', 'with savepb, store the weights as float32, float16 or int8 (dequantized in the graph) and report the accuracy against float32 on imgdir')
+        self.define('savepbDecode', False, 'with savepb, also export the box decode and NMS (YOLOv2) as boxes, scores, classes and count outputs')
         self.define('gpu', 0.0, 'how much gpu (from 0.0 to 1.0)')
         self.define('gpuName', '/gpu:0', 'GPU device name')
         self.define('lr', 1e-5, 'learning rate')
@@ -29,6 +37,7 @@ class argHandler(dict):
         self.define('batch', 16, 'batch size')
         self.define('epoch', 1000, 'number of epoch')
         self.define('save', 2000, 'save checkpoint every ? training examples')
+        self.define('profile', 0, 'time this many forward passes per layer, print the table and save it with a chrome trace to profile/')
         self.define('demo', '', 'demo on webcam')
         self.define('queue', 1, 'process demo in batch')
         self.define('json', False, 'Outputs bounding box information in json format.')
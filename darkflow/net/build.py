@@ -22,6 +22,13 @@ class TFNet(object):
 		'sgd': tf.train.GradientDescentOptimizer
 	})
 
+	# weight storage of savepb
+	_PRECISIONS = ['float32', 'float16', 'int8']
+
+	# outputs of framework.decode_graph
+	_DECODED = ['boxes', 'scores', 'classes', 'count']
+	decoded = None
+
 	# imported methods
 	_get_fps = help._get_fps
 	say = help.say
@@ -29,9 +36,17 @@ class TFNet(object):
 	camera = help.camera
 	predict = flow.predict
 	return_predict = flow.return_predict
+	return_predict_batch = flow.return_predict_batch
+	_boxes_info = flow._boxes_info
+	return_predict_array = flow.return_predict_array
+	_boxes_array = flow._boxes_array
+	_batch_input = flow._batch_input
+	_forward_decode = flow._forward_decode
 	to_darknet = help.to_darknet
 	build_train_op = help.build_train_op
 	load_from_ckpt = help.load_from_ckpt
+	optimize_graph = help.optimize_graph
+	precision_report = help.precision_report
 
 	def __init__(self, FLAGS, darknet = None):
 		self.ntrain = 0
@@ -94,6 +109,23 @@ class TFNet(object):
 		self.inp = tf.get_default_graph().get_tensor_by_name('input:0')
 		self.feed = dict() # other placeholders
 		self.out = tf.get_default_graph().get_tensor_by_name('output:0')
+
+		# decode and NMS exported with savepbDecode
+		self.decoded = None
+		names = set(op.name for op in tf.get_default_graph().get_operations())
+		if all(name in names for name in self._DECODED):
+			exported = self.meta.get('graph_decode')
+			runtime = self.framework.decode_settings()
+			if exported == runtime:
+				self.say('Using the decode and NMS of the graph')
+				self.decoded = [tf.get_default_graph().get_tensor_by_name(
+					'{}:0'.format(name)) for name in self._DECODED]
+			else:
+				# the graph would silently ignore the runtime flags
+				changed = sorted(key for key in runtime
+					if (exported or dict()).get(key) != runtime[key])
+				print('WARNING: decode settings {} differ from the exported '
+					'graph, falling back to the host decode'.format(changed))
 		
 		self.setup_meta_ops()
 	
@@ -161,10 +193,25 @@ class TFNet(object):
 		darknet_pb = self.to_darknet()
 		flags_pb = self.FLAGS
 		flags_pb.verbalise = False
+		precision = flags_pb.savepbPrecision
+		assert precision in self._PRECISIONS, \
+		'savepbPrecision: {} is not one of {}'.format(precision, self._PRECISIONS)
+		for layer in darknet_pb.layers:
+			if flags_pb.savepbOptimize and hasattr(layer, 'fold_batchnorm'):
+				layer.fold_batchnorm()
+			layer.precision = precision
 		
 		flags_pb.train = False
 		# rebuild another tfnet. all const.
 		tfnet_pb = TFNet(flags_pb, darknet_pb)		
+		self.meta.pop('graph_decode', None)
+		if flags_pb.savepbDecode:
+			assert hasattr(tfnet_pb.framework, 'decode_graph'), \
+			'savepbDecode: no in-graph decode for {}'.format(self.meta['type'])
+			self.say('Adding decode and NMS to the graph')
+			with tfnet_pb.graph.as_default():
+				tfnet_pb.framework.decode_graph(tfnet_pb.out)
+			self.meta['graph_decode'] = tfnet_pb.meta['graph_decode']
 		tfnet_pb.sess = tf.Session(graph = tfnet_pb.graph)
 		# tfnet_pb.predict() # uncomment for unit testing
 		name = 'built_graph/{}.pb'.format(self.meta['name'])
@@ -174,4 +221,9 @@ class TFNet(object):
 			json.dump(self.meta, fp)
 		self.say('Saving const graph def to {}'.format(name))
 		graph_def = tfnet_pb.sess.graph_def
-		tf.train.write_graph(graph_def,'./', name, False)
\ No newline at end of file
+		if flags_pb.savepbOptimize:
+			graph_def = self.optimize_graph(graph_def)
+		tf.train.write_graph(graph_def,'./', name, False)
+		if precision != 'float32':
+			self.precision_report(tfnet_pb,
+				'built_graph/{}.{}.json'.format(self.meta['name'], precision))
\ No newline at end of file
@@ -4,6 +4,7 @@ import numpy as np
 import tensorflow as tf
 import pickle
 from multiprocessing.pool import ThreadPool
+from ..utils.box import to_bound_boxes
 
 train_stats = (
     'Training statistics: \n'
@@ -79,16 +80,11 @@ def train(self):
 
     if ckpt: _save_ckpt(self, *args)
 
-def return_predict(self, im):
-    assert isinstance(im, np.ndarray), \
-				'Image is not a np.ndarray'
-    h, w, _ = im.shape
-    im = self.framework.resize_input(im)
-    this_inp = np.expand_dims(im, 0)
-    feed_dict = {self.inp : this_inp}
-
-    out = self.sess.run(self.out, feed_dict)[0]
-    boxes = self.framework.findboxes(out)
+def _boxes_info(self, out, h, w, found = None):
+    if found is None:
+        boxes = self.framework.findboxes(out)
+    else:
+        boxes = to_bound_boxes(*found, class_num = self.meta['classes'])
     threshold = self.FLAGS.threshold
     boxesInfo = list()
     for box in boxes:
@@ -105,8 +101,112 @@ def return_predict(self, im):
                 "x": tmpBox[1],
                 "y": tmpBox[3]}
         })
+    if self.FLAGS.maxDet:
+        boxesInfo.sort(key = lambda b: -b["confidence"])
+        boxesInfo = boxesInfo[:self.FLAGS.maxDet]
     return boxesInfo
 
+def _boxes_array(self, out, h, w, found = None):
+    """
+    Array version of _boxes_info: one float32 row per box with
+    left, top, right, bot (pixels), confidence and class index
+    into self.meta['labels']. The decoders already applied keepLabels
+    and NMS in findboxes_array (or _forward_decode, whose result for
+    this image can be passed as found), here the threshold and maxDet
+    options are applied
+    """
+    if found is None:
+        found = self.framework.findboxes_array(out)
+    xywh, confidence, class_idx = found
+    keep = confidence > self.FLAGS.threshold
+    if self.FLAGS.maxDet:
+        order = np.argsort(-confidence[keep], kind = 'stable')
+        keep = np.flatnonzero(keep)[order[:self.FLAGS.maxDet]]
+
+    xywh = xywh[keep]
+    result = np.empty((len(xywh), 6), dtype = np.float32)
+    result[:, 0] = ((xywh[:, 0] - xywh[:, 2] / 2.) * w).astype(int)
+    result[:, 2] = ((xywh[:, 0] + xywh[:, 2] / 2.) * w).astype(int)
+    result[:, 1] = ((xywh[:, 1] - xywh[:, 3] / 2.) * h).astype(int)
+    result[:, 3] = ((xywh[:, 1] + xywh[:, 3] / 2.) * h).astype(int)
+    np.clip(result[:, 0::2], 0, w - 1, out = result[:, 0::2])
+    np.clip(result[:, 1::2], 0, h - 1, out = result[:, 1::2])
+    result[:, 4] = confidence[keep]
+    result[:, 5] = class_idx[keep]
+    return result
+
+def return_predict(self, im):
+    assert isinstance(im, np.ndarray), \
+				'Image is not a np.ndarray'
+    h, w, _ = im.shape
+    im = self.framework.resize_input(im)
+    this_inp = np.expand_dims(im, 0)
+    feed_dict = {self.inp : this_inp}
+
+    out = self.sess.run(self.out, feed_dict)[0]
+    return self._boxes_info(out, h, w)
+
+def return_predict_array(self, im):
+    """
+    Same as return_predict but returns a (N, 6) float32 array,
+    see _boxes_array
+    """
+    assert isinstance(im, np.ndarray), \
+				'Image is not a np.ndarray'
+    h, w, _ = im.shape
+    net_out, found = self._forward_decode(
+        {self.inp : self._batch_input([im])})
+    return self._boxes_array(net_out[0], h, w, found[0])
+
+def _batch_input(self, frames):
+    """
+    Resize frames into one preallocated input tensor
+    """
+    n = len(frames)
+    inp_size = [n] + self.meta['inp_size']
+    batch_inp = getattr(self, '_batch_inp', None)
+    if batch_inp is None or batch_inp.shape[0] < n:
+        batch_inp = np.empty(inp_size, dtype = np.float32)
+        self._batch_inp = batch_inp
+    for i, im in enumerate(frames):
+        batch_inp[i] = self.framework.resize_input(im)
+    return batch_inp[:n]
+
+def _forward_decode(self, feed_dict):
+    """
+    sess.run of a batch, returns the net output and one (boxes,
+    scores, classes) tuple of arrays per image: fetched from the
+    graph when it was saved with savepbDecode, decoded on the host
+    by findboxes_batch otherwise
+    """
+    if self.decoded is None:
+        net_out = self.sess.run(self.out, feed_dict)
+        return net_out, self.framework.findboxes_batch(net_out)
+
+    fetches = [self.out] + self.decoded
+    net_out, boxes, scores, classes, count = \
+        self.sess.run(fetches, feed_dict)
+    return net_out, [(b[:n], s[:n], c[:n])
+        for b, s, c, n in zip(boxes, scores, classes, count)]
+
+def return_predict_batch(self, frames, as_array = False):
+    """
+    Batched return_predict: one sess.run for all frames,
+    returns one list of boxes per frame (or one array
+    per frame with as_array, see _boxes_array)
+    """
+    for im in frames:
+        assert isinstance(im, np.ndarray), \
+				'Image is not a np.ndarray'
+    if not len(frames):
+        return list()
+
+    net_out, found = self._forward_decode(
+        {self.inp : self._batch_input(frames)})
+    decode = self._boxes_array if as_array else self._boxes_info
+    return [decode(out, im.shape[0], im.shape[1], f)
+        for im, out, f in zip(frames, net_out, found)]
+
 import math
 
 def predict(self):
@@ -131,21 +231,23 @@ def predict(self):
             np.expand_dims(self.framework.preprocess(
                 os.path.join(inp_path, inp)), 0)), this_batch)
 
-        # Feed to the net
+        # Feed to the net, decode the whole batch at once
         feed_dict = {self.inp : np.concatenate(inp_feed, 0)}    
         self.say('Forwarding {} inputs ...'.format(len(inp_feed)))
         start = time.time()
-        out = self.sess.run(self.out, feed_dict)
+        out, found = self._forward_decode(feed_dict)
         stop = time.time(); last = stop - start
         self.say('Total time = {}s / {} inps = {} ips'.format(
             last, len(inp_feed), len(inp_feed) / last))
 
-        # Post processing
+        # Post processing: draw and save in the thread pool
         self.say('Post processing {} inputs ...'.format(len(inp_feed)))
         start = time.time()
+        classes = self.meta['classes']
         pool.map(lambda p: (lambda i, prediction:
             self.framework.postprocess(
-               prediction, os.path.join(inp_path, this_batch[i])))(*p),
+               prediction, os.path.join(inp_path, this_batch[i]),
+               boxes = to_bound_boxes(*found[i], class_num = classes)))(*p),
             enumerate(out))
         stop = time.time(); last = stop - start
 
@@ -29,6 +29,8 @@ class YOLO(framework):
     _batch = yolo.data._batch
     resize_input = yolo.predict.resize_input
     findboxes = yolo.predict.findboxes
+    findboxes_array = yolo.predict.findboxes_array
+    findboxes_batch = yolo.predict.findboxes_batch
     process_box = yolo.predict.process_box
 
 class YOLOv2(framework):
@@ -39,9 +41,14 @@ class YOLOv2(framework):
     loss = yolov2.train.loss
     is_inp = yolo.misc.is_inp
     postprocess = yolov2.predict.postprocess
+    profile = yolo.misc.profile
     _batch = yolov2.data._batch
     resize_input = yolo.predict.resize_input
     findboxes = yolov2.predict.findboxes
+    findboxes_array = yolov2.predict.findboxes_array
+    findboxes_batch = yolov2.predict.findboxes_batch
+    decode_graph = yolov2.predict.decode_graph
+    decode_settings = yolov2.predict.decode_settings
     process_box = yolo.predict.process_box
 
 """
@@ -2,9 +2,11 @@
 tfnet secondary (helper) methods
 """
 from ..utils.loader import create_loader
+from ..utils.box import to_bound_boxes
 from time import time as timer
 import tensorflow as tf
 import numpy as np
+import json
 import sys
 import cv2
 import os
@@ -103,9 +105,8 @@ def camera(self):
         videoWriter = cv2.VideoWriter(
             'video.avi', fourcc, fps, (width, height))
 
-    # buffers for demo in batch
+    # buffer for demo in batch
     buffer_inp = list()
-    buffer_pre = list()
     
     elapsed = int()
     start = timer()
@@ -117,24 +118,23 @@ def camera(self):
         if frame is None:
             print ('\nEnd of Video')
             break
-        preprocessed = self.framework.preprocess(frame)
         buffer_inp.append(frame)
-        buffer_pre.append(preprocessed)
         
         # Only process and imshow when queue is full
         if elapsed % self.FLAGS.queue == 0:
-            feed_dict = {self.inp: buffer_pre}
-            net_out = self.sess.run(self.out, feed_dict)
-            for img, single_out in zip(buffer_inp, net_out):
+            net_out, found = self._forward_decode(
+                {self.inp : self._batch_input(buffer_inp)})
+            for img, single_out, boxes in zip(buffer_inp, net_out, found):
+                boxes = to_bound_boxes(*boxes,
+                    class_num = self.meta['classes'])
                 postprocessed = self.framework.postprocess(
-                    single_out, img, False)
+                    single_out, img, False, boxes)
                 if SaveVideo:
                     videoWriter.write(postprocessed)
                 if file == 0: #camera window
                     cv2.imshow('', postprocessed)
-            # Clear Buffers
+            # Clear Buffer
             buffer_inp = list()
-            buffer_pre = list()
 
         if elapsed % 5 == 0:
             sys.stdout.write('\r')
@@ -169,3 +169,100 @@ def to_darknet(self):
             layer.h[ph] = None
 
     return darknet_ckpt
+
+def optimize_graph(self, graph_def):
+    """
+    Inference-only cleanup of a const graph def for savepb: drops
+    the nodes not needed by the outputs and the identity nodes,
+    then folds the constant subgraphs when graph_transforms exists
+    """
+    outputs = ['output'] + self._DECODED
+    names = set(node.name for node in graph_def.node)
+    outputs = [name for name in outputs if name in names]
+    protected = ['input'] + outputs
+
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, outputs)
+    graph_def = tf.graph_util.remove_training_nodes(
+        graph_def, protected_nodes = protected)
+    if self.FLAGS.savepbPrecision != 'float32':
+        # folding would turn the weights back into float32
+        return graph_def
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        self.say('No graph_transforms, constants are not folded')
+        return graph_def
+    return TransformGraph(graph_def, ['input'], outputs,
+        ['fold_constants(ignore_errors=true)', 'strip_unused_nodes'])
+
+def _iou(a, b):
+    """IoU matrix of two (N, 4+) arrays of x, y, w, h boxes"""
+    a1, a2 = a[:, None, :2] - a[:, None, 2:4] / 2., a[:, None, :2] + a[:, None, 2:4] / 2.
+    b1, b2 = b[None, :, :2] - b[None, :, 2:4] / 2., b[None, :, :2] + b[None, :, 2:4] / 2.
+    inter = np.prod(np.clip(np.minimum(a2, b2) - np.maximum(a1, b1), 0, None), -1)
+    union = np.prod(a[:, None, 2:4], -1) + np.prod(b[None, :, 2:4], -1) - inter
+    return inter / np.maximum(union, 1e-9)
+
+def precision_report(self, tfnet_pb, file_name):
+    """
+    Runs the float32 net and the reduced precision const net of
+    savepb on the images of imgdir and compares their outputs and
+    detections: a detection is matched by one of the same class
+    with IoU >= 0.5. Printed and saved as json to file_name
+    """
+    inp_path = self.FLAGS.imgdir
+    all_inps = sorted(i for i in os.listdir(inp_path)
+        if self.framework.is_inp(i))
+    if not all_inps or not hasattr(self.framework, 'findboxes_batch'):
+        print('No images in {} to compare precisions'.format(inp_path))
+        return
+
+    rows = list()
+    for inp in all_inps:
+        im = np.expand_dims(self.framework.preprocess(
+            os.path.join(inp_path, inp)), 0)
+        ref = self.sess.run(self.out, {self.inp : im})
+        out = tfnet_pb.sess.run(tfnet_pb.out, {tfnet_pb.inp : im})
+        error = float(np.abs(ref - out).max())
+        (ref_boxes, ref_scores, ref_classes), = self.framework.findboxes_batch(ref)
+        (boxes, scores, classes), = self.framework.findboxes_batch(out)
+
+        ious = _iou(ref_boxes, boxes)
+        ious[ref_classes[:, None] != classes[None, :]] = 0
+        matched, iou, score = 0, list(), list()
+        for i in range(len(ref_boxes)):
+            if not ious.shape[1] or ious[i].max() < .5: continue
+            j = ious[i].argmax()
+            matched += 1
+            iou += [ious[i, j]]
+            score += [abs(ref_scores[i] - scores[j])]
+            ious[:, j] = 0
+        rows.append({'image': inp, 'max_output_error': error,
+            'float32': len(ref_boxes), 'reduced': len(boxes),
+            'matched': matched,
+            'mean_iou': float(np.mean(iou)) if iou else None,
+            'max_score_error': float(np.max(score)) if score else None})
+
+    ref_total = sum(r['float32'] for r in rows)
+    total = sum(r['reduced'] for r in rows)
+    matched = sum(r['matched'] for r in rows)
+    summary = {'precision': self.FLAGS.savepbPrecision,
+        'images': len(rows),
+        'recall': matched / ref_total if ref_total else 1.,
+        'precision_vs_float32': matched / total if total else 1.,
+        'max_output_error': max(r['max_output_error'] for r in rows)}
+
+    form = '{:<32} {:>8} {:>8} {:>8} {:>9} {:>10}'
+    print(form.format('image', 'float32', summary['precision'],
+        'matched', 'mean IoU', 'out error'))
+    for r in rows:
+        mean_iou = '-' if r['mean_iou'] is None else '{:.3f}'.format(r['mean_iou'])
+        print(form.format(r['image'][:32], r['float32'], r['reduced'],
+            r['matched'], mean_iou, '{:.4f}'.format(r['max_output_error'])))
+    print('recall {:.3f}, precision {:.3f} against float32 on {} images'.format(
+        summary['recall'], summary['precision_vs_float32'], summary['images']))
+
+    with open(file_name, 'w') as f:
+        json.dump({'summary': summary, 'images': rows}, f, indent = 2)
+    print('Precision report saved to {}'.format(file_name))
+
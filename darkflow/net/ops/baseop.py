@@ -15,6 +15,21 @@ def _shape(tensor): # work for both tf.Tensor & np.ndarray
 def _name(tensor):
     return tensor.name.split(':')[0]
 
+def _dequantize(val, precision):
+    """
+    Const of val stored in reduced precision, cast back to
+    float32 in the graph: float16, or int8 with one scale
+    per output channel (last axis)
+    """
+    if precision == 'float16':
+        return tf.cast(tf.constant(val.astype(np.float16)), tf.float32)
+    axes = tuple(range(val.ndim - 1))
+    scale = np.abs(val).max(axis = axes) / 127.
+    scale[scale == 0] = 1.
+    quant = np.round(val / scale).astype(np.int8)
+    return tf.cast(tf.constant(quant), tf.float32) * \
+        scale.astype(np.float32)
+
 class BaseOp(object):
     """
     BaseOp objects initialise with a darknet's `layer` object
@@ -24,6 +39,8 @@ class BaseOp(object):
 
     # let slim take care of the following vars
     _SLIM = ['gamma', 'moving_mean', 'moving_variance']
+    # stored in layer.precision by a const graph (savepb)
+    _QUANTIZE = ['kernel', 'kernels', 'weights']
 
     def __init__(self, layer, inp, num, roof, feed):
         self.inp = inp # BaseOp
@@ -39,7 +56,9 @@ class BaseOp(object):
         self.convert(feed)
         if self.var: self.train_msg = 'Yep! '
         else: self.train_msg = 'Nope '
-        self.forward()
+        # every op of the layer under its scope (see yolo.misc.profile)
+        with tf.name_scope(self.scope + '/'):
+            self.forward()
 
     def convert(self, feed):
         """convert self.lay to variables & placeholders"""
@@ -62,7 +81,12 @@ class BaseOp(object):
                 val = np.random.normal(*args)
             self.lay.w[var] = val.astype(np.float32)
             self.act = 'Init '
-        if not self.var: return
+        if not self.var:
+            precision = getattr(self.lay, 'precision', 'float32')
+            if precision != 'float32' and var in self._QUANTIZE:
+                with tf.name_scope(self.scope):
+                    self.lay.w[var] = _dequantize(self.lay.w[var], precision)
+            return
 
         val = self.lay.w[var]
         self.lay.w[var] = tf.constant_initializer(val)
@@ -65,9 +65,14 @@ class local(BaseOp):
 
 class convolutional(BaseOp):
     def forward(self):
-        pad = [[self.lay.pad, self.lay.pad]] * 2;
-        temp = tf.pad(self.inp.out, [[0, 0]] + pad + [[0, 0]])
-        temp = tf.nn.conv2d(temp, self.lay.w['kernel'], padding = 'VALID', 
+        temp, padding = self.inp.out, 'VALID'
+        if self.lay.pad and self.lay.stride == 1 and \
+            2 * self.lay.pad == self.lay.ksize - 1:
+            padding = 'SAME' # same zero padding, without the tf.pad op
+        elif self.lay.pad:
+            pad = [[self.lay.pad, self.lay.pad]] * 2;
+            temp = tf.pad(temp, [[0, 0]] + pad + [[0, 0]])
+        temp = tf.nn.conv2d(temp, self.lay.w['kernel'], padding = padding, 
             name = self.scope, strides = [1] + [self.lay.stride] * 2 + [1])
         if self.lay.batch_norm: 
             temp = self.batchnorm(self.lay, temp)
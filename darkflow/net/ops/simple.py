@@ -83,7 +83,10 @@ class avgpool(BaseOp):
 class dropout(BaseOp):
 	def forward(self):
 		if self.lay.h['pdrop'] is None:
+			# const graph (savepb): nothing to drop
 			self.lay.h['pdrop'] = 1.0
+			self.out = tf.identity(self.inp.out, name = self.scope)
+			return
 		self.out = tf.nn.dropout(
 			self.inp.out, 
 			self.lay.h['pdrop'], 
@@ -34,4 +34,15 @@ def constructor(self, meta, FLAGS):
 
 	# over-ride the threshold in meta if FLAGS has it.
 	if FLAGS.threshold > 0.0:
-		self.meta['thresh'] = FLAGS.threshold
\ No newline at end of file
+		self.meta['thresh'] = FLAGS.threshold
+
+	# post-processing: NMS settings read by the decoders and the
+	# only classes they score (all of them when empty)
+	self.meta['nms'] = FLAGS.nms
+	self.meta['nms_agnostic'] = FLAGS.nmsAgnostic
+	self.meta['nms_top_k'] = FLAGS.nmsTopK
+	self.meta['keep_classes'] = list()
+	for label in filter(None, FLAGS.keepLabels.split(',')):
+		assert label in meta['labels'], \
+		'keepLabels: {} is not a label of {}'.format(label, meta['model'])
+		self.meta['keep_classes'] += [meta['labels'].index(label)]
\ No newline at end of file
@@ -1,5 +1,7 @@
-import pickle
 import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+import json
 import cv2
 import os
 
@@ -74,57 +76,98 @@ def show2(im, allobj):
     cv2.destroyAllWindows()
 
 
-_MVA = .05
+def _flops(op):
+    """floating point operations of one layer, for one image"""
+    lay = op.lay
+    size = int(np.prod(op.out.get_shape().as_list()[1:]))
+    if lay.type in ['convolutional', 'conv-select', 'conv-extract']:
+        k = lay.wshape['kernel'][:3]
+    elif lay.type == 'local':
+        k = lay.wshape['kernels'][1:4]
+    elif lay.type in ['connected', 'select', 'extract']:
+        inp, out = lay.wshape['weights']
+        return 2 * inp * out + out
+    elif lay.type == 'maxpool':
+        return size * lay.ksize * lay.ksize
+    elif lay.type == 'avgpool':
+        return int(np.prod(op.inp.out.get_shape().as_list()[1:]))
+    elif lay.type in ['route', 'reorg', 'flatten', 'dropout']:
+        return 0
+    else: # elementwise
+        return size
+    # multiply-adds, bias and batch norm
+    norm = 4 * size if getattr(lay, 'batch_norm', False) else 0
+    return 2 * size * int(np.prod(k)) + size + norm
 
 def profile(self, net):
-    pass
-#     data = self.parse(exclusive = True)
-#     size = len(data); batch = self.FLAGS.batch
-#     all_inp_ = [x[0] for x in data]
-#     net.say('Will cycle through {} examples {} times'.format(
-#         len(all_inp_), net.FLAGS.epoch))
-
-#     fetch = list(); mvave = list(); names = list();
-#     this = net.top
-#     conv_lay = ['convolutional', 'connected', 'local', 'conv-select']
-#     while this.inp is not None:
-#         if this.lay.type in conv_lay:
-#             fetch = [this.out] + fetch
-#             names = [this.lay.signature] + names
-#             mvave = [None] + mvave 
-#         this = this.inp
-#     print(names)
-
-#     total = int(); allofthem = len(all_inp_) * net.FLAGS.epoch
-#     batch = min(net.FLAGS.batch, len(all_inp_))
-#     for count in range(net.FLAGS.epoch):
-#         net.say('EPOCH {}'.format(count))
-#         for j in range(len(all_inp_)/batch):
-#             inp_feed = list(); new_all = list()
-#             all_inp = all_inp_[j*batch: (j*batch+batch)]
-#             for inp in all_inp:
-#                 new_all += [inp]
-#                 this_inp = os.path.join(net.FLAGS.dataset, inp)
-#                 this_inp = net.framework.preprocess(this_inp)
-#                 expanded = np.expand_dims(this_inp, 0)
-#                 inp_feed.append(expanded)
-#             all_inp = new_all
-#             feed_dict = {net.inp : np.concatenate(inp_feed, 0)}
-#             out = net.sess.run(fetch, feed_dict)
-
-#             for i, o in enumerate(out):
-#                 oi = out[i];
-#                 dim = len(oi.shape) - 1
-#                 ai = mvave[i]; 
-#                 mi = np.mean(oi, tuple(range(dim)))
-#                 vi = np.var(oi, tuple(range(dim)))
-#                 if ai is None: mvave[i] = [mi, vi]
-#                 elif 'banana ninja yada yada':
-#                     ai[0] = (1 - _MVA) * ai[0] + _MVA * mi
-#                     ai[1] = (1 - _MVA) * ai[1] + _MVA * vi
-#             total += len(inp_feed)
-#             net.say('{} / {} = {}%'.format(
-#                 total, allofthem, 100. * total / allofthem))
-
-#         with open('profile', 'wb') as f:
-#             pickle.dump([mvave], f, protocol = -1)
+    """
+    Times FLAGS.profile traced forward passes of one image and
+    reports, per layer, the mean ms, the FLOPs and the output
+    size. Ops are matched to layers by their 'i-type' scope.
+    Saves the table to profile/{name}.json and a chrome trace
+    (chrome://tracing) of the last pass to profile/{name}.trace.json
+    """
+    assert getattr(net, 'top', None) is not None, \
+    'profile needs a net built from .cfg, not from .pb'
+
+    layers = dict()
+    this = net.top
+    while this.inp is not None:
+        layers[this.num] = this
+        this = this.inp
+
+    runs = net.FLAGS.profile
+    feed_dict = {net.inp : np.random.uniform(
+        size = [1] + self.meta['inp_size']).astype(np.float32)}
+    net.sess.run(net.out, feed_dict) # warm up
+
+    micros = dict((num, 0) for num in layers)
+    other = 0
+    for _ in range(runs):
+        options = tf.RunOptions(trace_level = tf.RunOptions.FULL_TRACE)
+        metadata = tf.RunMetadata()
+        net.sess.run(net.out, feed_dict,
+            options = options, run_metadata = metadata)
+
+        # gpu kernels are timed on the stream:all device
+        devices = metadata.step_stats.dev_stats
+        streams = [d for d in devices if d.device.endswith('stream:all')]
+        for device in streams or devices:
+            for node in device.node_stats:
+                took = node.op_end_rel_micros - node.op_start_rel_micros
+                scope = node.node_name.split('/')[0].split(':')[0]
+                num = scope.split('-')[0]
+                if num.isdigit() and int(num) in micros:
+                    micros[int(num)] += took
+                else: other += took
+
+    rows = list()
+    total = sum(micros.values()) + other
+    for num in sorted(layers):
+        op = layers[num]
+        rows.append({'layer': op.scope, 'speak': op.speak() or op.lay.type,
+            'ms': micros[num] / 1000. / runs,
+            'flops': _flops(op),
+            'output': op.out.get_shape().as_list()[1:]})
+    rows.append({'layer': 'other', 'speak': 'input, output and runtime',
+        'ms': other / 1000. / runs, 'flops': 0, 'output': None})
+
+    form = '{:<18} | {:<32} | {:>8} | {:>6} | {:>9} | {}'
+    net.say(form.format('Scope', 'Layer description', 'ms', '%',
+        'MFLOPs', 'Output size'))
+    for row in rows:
+        share = 100. * row['ms'] * runs * 1000. / total if total else 0.
+        net.say(form.format(row['layer'], row['speak'][:32],
+            '{:.3f}'.format(row['ms']), '{:.1f}'.format(share),
+            '{:.1f}'.format(row['flops'] / 1e6), row['output'] or ''))
+    net.say('Total {:.3f} ms, {:.1f} MFLOPs per image over {} runs'.format(
+        total / 1000. / runs, sum(r['flops'] for r in rows) / 1e6, runs))
+
+    os.makedirs('profile', exist_ok = True)
+    name = os.path.join('profile', self.meta['name'])
+    with open(name + '.json', 'w') as f:
+        json.dump(rows, f, indent = 2)
+    trace = timeline.Timeline(metadata.step_stats)
+    with open(name + '.trace.json', 'w') as f:
+        f.write(trace.generate_chrome_trace_format())
+    net.say('Profile saved to {0}.json, chrome trace to {0}.trace.json'.format(name))
@@ -4,7 +4,7 @@ import numpy as np
 import cv2
 import os
 import json
-from ...cython_utils.cy_yolo_findboxes import yolo_box_constructor
+from ...cython_utils.cy_yolo_findboxes import yolo_box_constructor, yolo_box_constructor_array
 
 def _fix(obj, dims, scale, offs):
 	for i in range(1, 5):
@@ -46,6 +46,16 @@ def findboxes(self, net_out):
 	
 	return boxes
 
+def findboxes_array(self, net_out):
+	"""
+	findboxes without BoundBox objects: arrays of
+	boxes (x, y, w, h, c), best class scores and class indices
+	"""
+	return yolo_box_constructor_array(self.meta, net_out, self.FLAGS.threshold)
+
+def findboxes_batch(self, net_out):
+	return [self.findboxes_array(out) for out in net_out]
+
 def preprocess(self, im, allobj = None):
 	"""
 	Takes an image, return it as a numpy tensor that is readily
@@ -74,7 +84,7 @@ def preprocess(self, im, allobj = None):
 	if allobj is None: return im
 	return im#, np.array(im) # for unit testing
 
-def postprocess(self, net_out, im, save = True):
+def postprocess(self, net_out, im, save = True, boxes = None):
 	"""
 	Takes net output, draw predictions, save to disk
 	"""
@@ -82,7 +92,8 @@ def postprocess(self, net_out, im, save = True):
 	threshold = FLAGS.threshold
 	colors, labels = meta['colors'], meta['labels']
 
-	boxes = self.findboxes(net_out)
+	if boxes is None:
+		boxes = self.findboxes(net_out)
 
 	if type(im) is not np.ndarray:
 		imgcv = cv2.imread(im)
@@ -1,4 +1,5 @@
 import numpy as np
+import tensorflow as tf
 import math
 import cv2
 import os
@@ -7,7 +8,8 @@ import json
 #from utils.box import BoundBox, box_iou, prob_compare
 #from utils.box import prob_compare2, box_intersection
 from ...utils.box import BoundBox
-from ...cython_utils.cy_yolo2_findboxes import box_constructor
+from ...cython_utils.cy_yolo2_findboxes import box_constructor, box_constructor_array
+from ...cython_utils.cy_yolo2_findboxes import box_constructor_batch
 
 def expit(x):
 	return 1. / (1. + np.exp(-x))
@@ -24,11 +26,136 @@ def findboxes(self, net_out):
 	boxes=box_constructor(meta,net_out)
 	return boxes
 
-def postprocess(self, net_out, im, save = True):
+def findboxes_array(self, net_out):
+	"""
+	findboxes without BoundBox objects: arrays of
+	boxes (x, y, w, h, c), best class scores and class indices
+	"""
+	return box_constructor_array(self.meta, net_out)
+
+def findboxes_batch(self, net_out):
+	"""
+	findboxes_array of a whole output batch,
+	decoded in parallel by the cython extension
+	"""
+	return box_constructor_batch(self.meta, net_out)
+
+def decode_settings(self):
+	"""
+	The meta and FLAGS values decode_graph bakes into the graph, stored
+	in .meta as graph_decode so build_from_pb can tell when the runtime
+	flags ask for something else
+	"""
+	meta, FLAGS = self.meta, self.FLAGS
+	H, W, _ = meta['out_size']
+	top_k = meta.get('nms_top_k') or 0
+	# at most one detection per anchor comes out of the NMS
+	size = min(top_k or H * W * meta['num'], H * W * meta['num'])
+	return {
+		'thresh': meta['thresh'],
+		'nms': meta.get('nms', 0.4),
+		'nms_agnostic': meta.get('nms_agnostic', False),
+		'nms_top_k': top_k,
+		'keep_classes': meta.get('keep_classes') or list(range(meta['classes'])),
+		'max_det': min(FLAGS.maxDet or size, size)}
+
+def decode_graph(self, net_out):
+	"""
+	box_constructor_batch as graph ops appended to net_out, for
+	savepb. Adds the outputs boxes (N, M, 5 with x, y, w, h relative
+	to the image and objectness), scores (N, M), classes (N, M) and
+	count (N,): only the first count[i] rows of image i are
+	detections. M is the number of anchors, or the nmsTopK cap or
+	maxDet when smaller
+	"""
+	meta = self.meta
+	H, W, _ = meta['out_size']
+	C, B = meta['classes'], meta['num']
+	settings = meta['graph_decode'] = self.decode_settings()
+	keep, top_k = settings['keep_classes'], settings['nms_top_k']
+	size = settings['max_det']
+
+	grid_y, grid_x = np.mgrid[:H, :W]
+	grid = np.stack([grid_x, grid_y], -1).reshape([1, H, W, 1, 2])
+	scale = np.array([W, H], dtype = np.float32)
+	anchors = np.reshape(meta['anchors'], [1, 1, 1, B, 2]) / scale
+
+	with tf.name_scope('decode'):
+		out = tf.reshape(net_out, [-1, H, W, B, 5 + C])
+		xy = (tf.sigmoid(out[..., 0:2]) + grid.astype(np.float32)) / scale
+		wh = tf.exp(out[..., 2:4]) * anchors.astype(np.float32)
+		obj = tf.sigmoid(out[..., 4:5])
+		# softmax over all classes, then only the kept ones
+		probs = tf.gather(tf.nn.softmax(out[..., 5:]), keep, axis = -1) * obj
+		xywhc = tf.reshape(tf.concat([xy, wh, obj], -1), [-1, H * W * B, 5])
+		probs = tf.reshape(probs, [-1, H * W * B, len(keep)])
+
+	def _nms(args):
+		xywhc, probs = args
+		if settings['nms_agnostic']:
+			# every anchor only competes with its best class
+			scores = tf.reduce_max(probs, -1)
+			cells = tf.range(tf.shape(scores)[0])
+			classes = tf.argmax(probs, -1, output_type = tf.int32)
+			mask = scores > settings['thresh']
+			cells = tf.boolean_mask(cells, mask)
+			scores = tf.boolean_mask(scores, mask)
+			classes = tf.boolean_mask(classes, mask)
+		else:
+			# one candidate per (anchor, class) above the threshold,
+			# as the host NMS_c
+			pairs = tf.cast(tf.where(probs > settings['thresh']), tf.int32)
+			cells, classes = pairs[:, 0], pairs[:, 1]
+			scores = tf.gather_nd(probs, pairs)
+		classes = tf.gather(tf.constant(keep, tf.int32), classes)
+
+		# best top_k candidates only, 0 keeps all
+		count = tf.shape(scores)[0]
+		scores, index = tf.nn.top_k(scores,
+			tf.minimum(top_k, count) if top_k else count)
+		cells = tf.gather(cells, index)
+		classes = tf.gather(classes, index)
+		xywhc = tf.gather(xywhc, cells)
+
+		corners = tf.concat([xywhc[:, :2] - xywhc[:, 2:4] / 2.,
+			xywhc[:, :2] + xywhc[:, 2:4] / 2.], -1)
+		if not settings['nms_agnostic']:
+			# boxes of different classes never overlap
+			offset = tf.reduce_max(tf.abs(corners)) * 2. + 1.
+			corners += tf.expand_dims(tf.cast(classes, tf.float32) * offset, -1)
+		index = tf.image.non_max_suppression(
+			corners, scores, tf.shape(scores)[0], settings['nms'])
+
+		# the first, best survivor of an anchor carries its class, the
+		# other classes of that anchor are dropped as in NMS_c
+		unique, where = tf.unique(tf.gather(cells, index))
+		first = tf.unsorted_segment_min(
+			tf.range(tf.shape(index)[0]), where, tf.shape(unique)[0])
+		index = tf.gather(index, first)[:size]
+
+		count = tf.shape(index)[0]
+		pad = size - count
+		return (tf.pad(tf.gather(xywhc, index), [[0, pad], [0, 0]]),
+			tf.pad(tf.gather(scores, index), [[0, pad]]),
+			tf.pad(tf.gather(classes, index), [[0, pad]]),
+			count)
+
+	with tf.name_scope('nms'):
+		boxes, scores, classes, count = tf.map_fn(_nms, (xywhc, probs),
+			dtype = (tf.float32, tf.float32, tf.int32, tf.int32),
+			back_prop = False)
+
+	return [tf.identity(boxes, name = 'boxes'),
+		tf.identity(scores, name = 'scores'),
+		tf.identity(classes, name = 'classes'),
+		tf.identity(count, name = 'count')]
+
+def postprocess(self, net_out, im, save = True, boxes = None):
 	"""
 	Takes net output, draw net_out, save to disk
 	"""
-	boxes = self.findboxes(net_out)
+	if boxes is None:
+		boxes = self.findboxes(net_out)
 
 	# meta
 	meta = self.meta
@@ -8,6 +8,19 @@ class BoundBox:
         self.class_num = classes
         self.probs = np.zeros((classes,))
 
+def to_bound_boxes(boxes, scores, classes, class_num):
+    """
+    BoundBox list from the box, score and class
+    arrays returned by the cython box constructors
+    """
+    result = list()
+    for (x, y, w, h, c), score, class_idx in zip(boxes, scores, classes):
+        bb = BoundBox(class_num)
+        bb.x, bb.y, bb.w, bb.h, bb.c = x, y, w, h, c
+        bb.probs[class_idx] = score
+        result.append(bb)
+    return result
+
 def overlap(x1,w1,x2,w2):
     l1 = x1 - w1 / 2.;
     l2 = x2 - w2 / 2.;
@@ -0,0 +1,98 @@
+import os
+import io
+import csv
+import json
+
+class CrossingLog(object):
+    """
+    Streaming sink of counting events: one record per counted vehicle
+    (frame, video timestamp, line, class and track id) plus a per-second
+    roll-up of the counts of every line, written next to it with a
+    ".seconds" suffix. Records are kept in memory and written in one batch
+    whenever a video second is completed or buffer_size events are pending,
+    so at most about a second of data is lost on a crash. The format is csv
+    when path ends in .csv and jsonl otherwise.
+    """
+
+    EVENT_FIELDS = ["frame", "msec", "line", "class", "track"]
+    SECOND_FIELDS = ["second", "line", "count", "total"]
+
+    def __init__(self, path, lines_count, buffer_size=256):
+        root, ext = os.path.splitext(path)
+        self.csv = ext.lower() == ".csv"
+        self.lines_count = lines_count
+        self.buffer_size = buffer_size
+
+        self.events_file = self.open(path, self.EVENT_FIELDS)
+        self.seconds_file = self.open(root + ".seconds" + ext, self.SECOND_FIELDS)
+        self.events = []
+        self.seconds = []
+
+        self.second = 0
+        self.counts = [0] * lines_count
+        self.total = 0
+
+    def open(self, path, fields):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        f = open(path, "a")
+        if self.csv and new:
+            f.write(",".join(fields) + "\n")
+        return f
+
+    def format(self, records, fields):
+        if not self.csv:
+            return "".join(json.dumps(dict(zip(fields, r))) + "\n" for r in records)
+        out = io.StringIO()
+        csv.writer(out, lineterminator="\n").writerows(records)
+        return out.getvalue()
+
+    def tick(self, msec):
+        # advance the video clock, rolling up every completed second
+        second = int(msec // 1000)
+        if second <= self.second:
+            return
+        for s in range(self.second, second):
+            for line in range(self.lines_count):
+                self.seconds.append((s, line, self.counts[line], self.total))
+            self.counts = [0] * self.lines_count
+        self.second = second
+        self.flush()
+
+    def add(self, frame, msec, line, label, track):
+        self.tick(msec)
+        self.events.append((int(frame), round(float(msec), 3), int(line), label, int(track)))
+        self.counts[line] += 1
+        self.total += 1
+        if len(self.events) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for f, records, fields in ((self.events_file, self.events, self.EVENT_FIELDS),
+                                   (self.seconds_file, self.seconds, self.SECOND_FIELDS)):
+            if not records:
+                continue
+            f.write(self.format(records, fields))
+            f.flush()
+            os.fsync(f.fileno())
+            del records[:]
+
+    def offsets(self):
+        # flush and return the sizes of both files, saved by checkpoints
+        self.flush()
+        return [self.events_file.tell(), self.seconds_file.tell()]
+
+    def truncate(self, offsets):
+        # drop what was written after the checkpoint of offsets, when
+        # resuming, so the replayed frames do not log their events twice
+        del self.events[:]
+        del self.seconds[:]
+        for f, offset in zip((self.events_file, self.seconds_file), offsets):
+            f.flush()
+            f.truncate(offset)
+            f.seek(offset)
+
+    def close(self):
+        # roll up the last, partial second too
+        self.tick((self.second + 1) * 1000)
+        self.events_file.close()
+        self.seconds_file.close()
@@ -1,12 +1,16 @@
 from darkflow.net.build import TFNet
 import numpy as np
 import cv2
-import sys
+import os
 import copy
+import argparse
 import json
 import time
+import queue
+import threading
 from pyimagesearch.centroidtracker import CentroidTracker
 from pyimagesearch.bbox_suppression import non_max_suppression_fast
+from event_log import CrossingLog
 
 def draw_line(img, line_points):
     color = (0, 255, 0)
@@ -24,15 +28,13 @@ def draw_components(img, lines):
         for point in line:
             draw_point(img, point)
 
-def draw_bboxes(frame, bboxes, colors):
-    for bbox in bboxes:
-        confidence  = bbox["confidence"]
-        topL = bbox["topleft"]
-        bottomR = bbox["bottomright"]
-        color = colors[ bbox["label"] ]
+def draw_bboxes(frame, bboxes, colors, labels):
+    for x1, y1, x2, y2, confidence, class_id in bboxes:
+        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+        color = colors[ labels[int(class_id)] ]
 
-        cv2.rectangle(frame, (topL['x'], topL['y']), (bottomR['x'], bottomR['y']), color, 2)
-        print_text_image(str(confidence)[:4], frame, (topL['x']+4, topL['y']+10), 0.3, color, 1)
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        print_text_image(str(confidence)[:4], frame, (x1+4, y1+10), 0.3, color, 1)
 
 def draw_centroid(frame, objs):
     for (objectID, centroid) in objs.items():
@@ -75,7 +77,12 @@ def draw_notification_board(image, ground_truth, estimated):
 
 
 def get_frame_bboxes(tfnet, frame):
-    return tfnet.return_predict(frame)
+    return tfnet.return_predict_array(frame)
+
+def get_frames_bboxes(tfnet, frames):
+    if len(frames) == 1:
+        return [get_frame_bboxes(tfnet, frames[0])]
+    return tfnet.return_predict_batch(frames, as_array=True)
 
 def load_lines(file_name):
     lines_file = open(file_name, "r")
@@ -84,104 +91,570 @@ def load_lines(file_name):
     return lines
 
 def get_lines_bboxes(lines):
-    lines_bbxs = []
-
-    for line in lines:
-        topL_x, bottomR_x = (line[0][0], line[1][0]) if line[0][0] < line[1][0] else (line[1][0], line[0][0])
-        topL_y, bottomR_y = (line[0][1], line[1][1]) if line[0][1] < line[1][1] else (line[1][1], line[0][1])
-
-        bbox = {}
-        bbox['topleft'] = {}
-        bbox['bottomright'] = {}
-        bbox['topleft']['x'] = topL_x
-        bbox['topleft']['y'] = topL_y
-        bbox['bottomright']['x'] = bottomR_x
-        bbox['bottomright']['y'] = bottomR_y
-        lines_bbxs.append(bbox)
-
-    return lines_bbxs
+    # (L, 4) rows of x1, y1, x2, y2 around each line
+    points = np.array([line[:2] for line in lines], dtype=np.float32).reshape(-1, 2, 2)
+    return np.concatenate((points.min(axis=1), points.max(axis=1)), axis=1)
+
+def get_lines_windows(lines_bbxs, frame_shape, inp_size, pad):
+    # padded window around each line bbox, grown along its shorter side to
+    # the aspect ratio of the net input so crops are not distorted when
+    # resized, and clipped to the frame
+    height, width = frame_shape[:2]
+    aspect = float(inp_size[1]) / inp_size[0]
+    windows = []
+
+    for bbox in lines_bbxs.astype(int):
+        x1, y1, x2, y2 = bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad
+
+        w, h = x2 - x1, y2 - y1
+        if w < h * aspect:
+            grow = int(h * aspect) - w
+            x1, x2 = x1 - grow // 2, x2 + grow - grow // 2
+        else:
+            grow = int(w / aspect) - h
+            y1, y2 = y1 - grow // 2, y2 + grow - grow // 2
+
+        windows.append((max(0, x1), max(0, y1), min(width, x2), min(height, y2)))
+
+    return windows
+
+def get_lines_segments(lines):
+    # (L, 2, 2) end points of each line
+    return np.array([line[:2] for line in lines], dtype=np.float32).reshape(-1, 2, 2)
+
+def cross(u, v):
+    return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+
+def does_segments_cross(starts, ends, segments):
+    # (tracks x lines) mask of the track motions (starts -> ends) crossing
+    # each line segment; an end point lying on a line counts on one side
+    # only, so a track stopping on a line is not counted twice
+    p, q = starts[:, None, :], ends[:, None, :]
+    a, b = segments[None, :, 0], segments[None, :, 1]
+    side_p = cross(b - a, p - a) > 0
+    side_q = cross(b - a, q - a) > 0
+    side_a = cross(q - p, a - p)
+    side_b = cross(q - p, b - p)
+    return (side_p != side_q) & (side_a * side_b <= 0)
+
+def does_bbxs_overlap(a, b):
+    # elementwise overlap mask of two broadcastable box arrays
+    return (a[..., 0] < b[..., 2]) & (a[..., 2] > b[..., 0]) & \
+           (a[..., 1] < b[..., 3]) & (a[..., 3] > b[..., 1])
 
 def does_bbxs_intersect(a, b):
-    c1 = a['topleft']['x'] < b['bottomright']['x']
-    c2 = a['bottomright']['x'] > b['topleft']['x']
-    c3 = a['topleft']['y'] < b['bottomright']['y']
-    c4 = a['bottomright']['y'] > b['topleft']['y']
-
-    intersect = c1 and c2 and c3 and c4
-    return intersect
+    # (len(a), len(b)) mask of the overlapping pairs of two box arrays
+    return does_bbxs_overlap(a[:, None, :4], b[None, :, :4])
 
 def filter_bboxes(bbxs, lines_bbxs):
-    filtered_bboxes = []
-
-    for line_bbx in lines_bbxs:
-        filtered_bboxes.append([])
-        for bbx in bbxs:
-            if does_bbxs_intersect(bbx, line_bbx):
-                filtered_bboxes[-1].append(bbx)
-
-    return filtered_bboxes
+    # indexes of the boxes touching each line, from one (lines x boxes) mask
+    intersect = does_bbxs_intersect(lines_bbxs, bbxs)
+    return [np.flatnonzero(line_mask) for line_mask in intersect]
+
+class LinesIndex(object):
+    """
+    Coarse raster over the frame where every cell holds, as a bitmask of
+    uint64 words, the lines whose bbox touches it. Built once per video, it
+    lets filter() test each box only against the lines of the cells it
+    covers, so its cost does not grow with the number of lines. Up to
+    BROADCAST_LINES lines the plain (lines x boxes) test of filter_bboxes
+    is cheaper and is used instead.
+    """
+
+    SHIFTS = np.arange(64, dtype=np.uint64)
+    BROADCAST_LINES = 16
+
+    def __init__(self, lines_bbxs, cell=32):
+        self.lines_bbxs = lines_bbxs
+        self.cell = cell
+        self.words = max(1, (len(lines_bbxs) + 63) // 64)
+
+        cells = (lines_bbxs // cell).astype(int)
+        grid_w = cells[:, 2].max() + 1 if len(cells) else 0
+        grid_h = cells[:, 3].max() + 1 if len(cells) else 0
+        self.raster = np.zeros((grid_h, grid_w, self.words), dtype=np.uint64)
+        for line, (cx1, cy1, cx2, cy2) in enumerate(cells):
+            bit = np.uint64(1) << np.uint64(line % 64)
+            self.raster[cy1:cy2 + 1, cx1:cx2 + 1, line // 64] |= bit
+
+    def filter(self, bbxs):
+        # same result as filter_bboxes
+        lines_count = len(self.lines_bbxs)
+        if lines_count <= self.BROADCAST_LINES or len(bbxs) == 0:
+            return filter_bboxes(bbxs, self.lines_bbxs)
+
+        # cell range of every box, clipped to the raster
+        grid_h, grid_w = self.raster.shape[:2]
+        cells = (bbxs[:, :4] // self.cell).astype(int)
+        x1 = np.maximum(cells[:, 0], 0)
+        y1 = np.maximum(cells[:, 1], 0)
+        nx = np.maximum(np.minimum(cells[:, 2], grid_w - 1) - x1 + 1, 0)
+        ny = np.maximum(np.minimum(cells[:, 3], grid_h - 1) - y1 + 1, 0)
+        n = nx * ny
+        boxes = np.flatnonzero(n)
+        if len(boxes) == 0:
+            return [np.empty(0, dtype=int) for _ in range(lines_count)]
+        x1, y1, nx, n = x1[boxes], y1[boxes], nx[boxes], n[boxes]
+
+        # one row per (box, cell), the cells of a box being contiguous,
+        # and the OR of the line bitmasks of each box
+        starts = np.cumsum(n) - n
+        offset = np.arange(n.sum()) - np.repeat(starts, n)
+        width = np.repeat(nx, n)
+        cx = np.repeat(x1, n) + offset % width
+        cy = np.repeat(y1, n) + offset // width
+        bits = np.bitwise_or.reduceat(self.raster[cy, cx], starts, axis=0)
+
+        # candidate (box, line) pairs, tested in one go
+        candidates = ((bits[:, :, None] >> self.SHIFTS) & np.uint64(1)).astype(bool)
+        box_idx, line_idx = np.nonzero(candidates.reshape(len(boxes), -1)[:, :lines_count])
+        box_idx = boxes[box_idx]
+        hits = does_bbxs_overlap(self.lines_bbxs[line_idx], bbxs[box_idx, :4])
+        box_idx, line_idx = box_idx[hits], line_idx[hits]
+
+        # boxes of each line, in increasing order as filter_bboxes
+        order = np.argsort(line_idx, kind="stable")
+        bounds = np.cumsum(np.bincount(line_idx, minlength=lines_count))[:-1]
+        return np.split(box_idx[order], bounds)
 
 def convert_bboxes_format(bboxes):
-    new_format = []
-
-    for bbox in bboxes:
-        topL = bbox['topleft']
-        bottomR = bbox['bottomright']
-        new_format.append(np.array([topL['x'], topL['y'], bottomR['x'], bottomR['y']]))
-
-    return new_format
-
-def separate_bbox_by_class(bboxes, classes):
-    separated = []
-    for i in range(len(classes)):
-        separated.append([])
-
-    for bbox in bboxes:
-        index = classes.index(bbox["label"])
-        separated[index].append(bbox)
-
-    return separated
+    return bboxes[:, :4]
+
+def separate_bbox_by_class(bboxes, classes, labels):
+    # indexes of the boxes of each class in classes
+    class_ids = bboxes[:, 5]
+    return [np.flatnonzero(class_ids == labels.index(c)) for c in classes]
+
+def read_frames(cap, frames, stop, strides=1, index=0):
+    # decode stage: runs on its own thread so cap.read() overlaps inference.
+    # only every stride-th frame is decoded, the ones in between are skipped
+    # with cap.grab(); strides is either a fixed int or a queue fed with
+    # one stride per keyframe by the inference stage. index is the number
+    # of the first frame, when resuming mid-stream
+    skip = 0
+    while cap.isOpened() and not stop.is_set():
+        if skip > 0:
+            if not cap.grab():
+                break
+            skip -= 1
+            index += 1
+            continue
 
-def compute_video(cap, lines, video_writer, ground_truth):
-
-    classes = ["car", "bus", "truck", "motorcycle"]
-    lines_bbxs = get_lines_bboxes(lines)
-
-    trackers = [CentroidTracker(maxDisappeared=10) for _ in range(len(lines_bbxs))]
-    fps = 60
-    ret = True
-    t = 0
-    while cap.isOpened() and ret:
         ret, frame = cap.read()
-        if ret:
-            bboxes = get_frame_bboxes(tfnet, frame)
-
-        draw_lines(frame, lines)
+        if not ret:
+            break
+        put_frame(frames, (index, cap.get(cv2.CAP_PROP_POS_MSEC), frame), stop)
+        index += 1
+        skip = get_stride(strides, stop) - 1
+    put_frame(frames, None, stop)
+
+def get_stride(strides, stop):
+    if isinstance(strides, int):
+        return strides
+    while not stop.is_set():
+        try:
+            return strides.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return 1
+
+def adaptive_stride(trackers, max_stride, max_step):
+    # keep the fastest track from moving more than max_step pixels
+    # between two detections
+    speed = max([tracker.maxSpeed() for tracker in trackers] + [0.0])
+    if speed <= 0:
+        return max_stride
+    return int(max(1, min(max_stride, max_step // speed)))
+
+def write_frames(video_writer, frames):
+    # encode stage: consumes frames in the order they were queued
+    while True:
+        frame = frames.get()
+        if frame is None:
+            break
+        video_writer.write(frame)
 
-        intersectig_bboxes = filter_bboxes(bboxes, lines_bbxs)
+def put_frame(frames, frame, stop):
+    # bounded put that gives up once the pipeline is being torn down
+    while not stop.is_set():
+        try:
+            frames.put(frame, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def read_batch(frames, batch_size):
+    # collect up to batch_size frames, stopping early at end of stream
+    batch = []
+    while len(batch) < batch_size:
+        frame = frames.get()
+        if frame is None:
+            return batch, True
+        batch.append(frame)
+    return batch, False
+
+class VideoStream(object):
+    """
+    Per-camera state of compute_videos: the capture and its reader thread,
+    the counting lines and their trackers, and the writer thread.
+    With tracking="per-line" each line has its own tracker fed with the
+    boxes touching it and counts its registered objects; with "global" one
+    tracker follows every box of the frame and a vehicle is counted when
+    its motion between two detections crosses a line.
+    With a checkpoint path the counting state is saved there every
+    checkpoint_every seconds of video, and a stream whose checkpoint
+    already exists resumes from it (its output video then only covers the
+    resumed part).
+    Without a video_writer the stream only counts: nothing is drawn or
+    encoded. render_every > 1 renders and writes one processed frame out of
+    every render_every. With an events path every counted vehicle is
+    logged to a CrossingLog.
+    """
+
+    def __init__(self, cap, lines, video_writer, ground_truth, name=None,
+            stride=1, max_stride=8, max_step=16.0, roi_pad=None, render_every=1,
+            events=None, assignment="greedy", max_distance=50.0, tracking="per-line",
+            checkpoint=None, checkpoint_every=60, class_aware_nms=False):
+        self.cap = cap
+        self.lines = lines
+        self.video_writer = video_writer
+        self.render_every = render_every
+        self.last_rendered = -1
+        self.processed = 0
+        self.ground_truth = ground_truth
+        self.name = name
+        self.lines_bbxs = get_lines_bboxes(lines)
+        self.lines_index = LinesIndex(self.lines_bbxs)
+        self.lines_segments = get_lines_segments(lines)
+        self.class_aware_nms = class_aware_nms
+        self.events = CrossingLog(events, len(lines)) if events else None
+
+        # with a detection stride the trackers carry each object between
+        # keyframes with a constant-velocity Kalman prediction
+        self.stride = stride
+        self.max_stride = max_stride
+        self.max_step = max_step
+        self.use_kalman = stride != 1
+        self.tracking = tracking
+        trackers_count = 1 if tracking == "global" else len(self.lines_bbxs)
+        self.trackers = [CentroidTracker(maxDisappeared=10, kalman=self.use_kalman,
+                                         assignment=assignment, maxDistance=max_distance)
+                         for _ in range(trackers_count)]
+
+        # global tracking: crossings per line and the (track, line) pairs
+        # already counted
+        self.crossings = np.zeros(len(lines), dtype=int)
+        self.counted = set()
+
+        self.roi_pad = roi_pad
+        self.windows = None
+        self.fps = 60
+        self.seconds = 0
+        self.last_index = -1
+        self.total = 0
+        self.done = False
+
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        if checkpoint and os.path.exists(checkpoint):
+            self.resume()
+
+    def start(self, stop, batch_size, queue_size):
+        # reader -> inference -> writer, connected by bounded queues;
+        # tracking stays on the inference thread so frame order is preserved
+        self.read_queue = queue.Queue(maxsize=max(queue_size, 2 * batch_size))
+        self.write_queue = queue.Queue(maxsize=max(queue_size, 2 * batch_size))
+
+        self.strides = self.stride
+        if self.stride == "auto":
+            # the stride of keyframe k + batch_size + 1 is decided on keyframe
+            # k, so the reader can run ahead and the schedule stays the same
+            # from run to run
+            self.strides = queue.Queue()
+            for _ in range(batch_size + 1):
+                self.strides.put(1)
+
+        self.reader = threading.Thread(target=read_frames,
+                                       args=(self.cap, self.read_queue, stop, self.strides,
+                                             self.last_index + 1))
+        self.reader.daemon = True
+        self.reader.start()
+
+        self.writer = None
+        if self.video_writer is not None:
+            self.writer = threading.Thread(target=write_frames,
+                                           args=(self.video_writer, self.write_queue))
+            self.writer.daemon = True
+            self.writer.start()
+
+    def stop(self):
+        if self.writer is not None:
+            # the stop event is already set here, so retry the end marker
+            # for as long as the writer can still take it: a writer that
+            # died leaves the queue full and must not hang the teardown
+            while self.writer.is_alive():
+                try:
+                    self.write_queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self.writer.join()
+        self.reader.join()
+        if self.events is not None:
+            self.events.close()
+
+    def save_checkpoint(self):
+        state = {"index": np.array(self.last_index), "seconds": np.array(self.seconds),
+                 "processed": np.array(self.processed), "crossings": self.crossings,
+                 "counted": np.array(sorted(self.counted), dtype=int).reshape(-1, 2)}
+        if self.events is not None:
+            state["events_second"] = np.array(self.events.second)
+            state["events_counts"] = np.array(self.events.counts)
+            state["events_total"] = np.array(self.events.total)
+            state["events_offsets"] = np.array(self.events.offsets())
+        for i, tracker in enumerate(self.trackers):
+            for name, value in tracker.state().items():
+                state["tracker%d_%s" % (i, name)] = value
+
+        # write aside and rename so a crash never leaves a partial file
+        temp = self.checkpoint + ".tmp"
+        with open(temp, "wb") as f:
+            np.savez_compressed(f, **state)
+        os.replace(temp, self.checkpoint)
+
+    def resume(self):
+        with np.load(self.checkpoint) as state:
+            self.last_index = int(state["index"])
+            self.last_rendered = self.last_index
+            self.seconds = int(state["seconds"])
+            self.processed = int(state["processed"])
+            self.crossings = state["crossings"]
+            self.counted = set(tuple(key) for key in state["counted"].tolist())
+            if self.events is not None and "events_second" in state:
+                self.events.second = int(state["events_second"])
+                self.events.counts = state["events_counts"].tolist()
+                self.events.total = int(state["events_total"])
+                if "events_offsets" in state:
+                    self.events.truncate(state["events_offsets"].tolist())
+            for i, tracker in enumerate(self.trackers):
+                prefix = "tracker%d_" % i
+                tracker.setState(dict((key[len(prefix):], state[key])
+                                      for key in state.files if key.startswith(prefix)))
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.last_index + 1)
+
+    def log_new_objects(self, line, index, msec, first_id):
+        # the objects registered by this update are the counted vehicles
+        tracker = self.trackers[line]
+        labels = tfnet.meta['labels']
+        slots = np.flatnonzero(tracker.active & (tracker.ids >= first_id))
+        for objectID, class_id in zip(tracker.ids[slots], tracker.classIds[slots]):
+            label = labels[class_id] if class_id >= 0 else None
+            self.events.add(index, msec, line, label, objectID)
+
+    def crops(self, frames):
+        # windows around the lines, computed on the first frame
+        if self.windows is None and frames:
+            self.windows = get_lines_windows(self.lines_bbxs, frames[0].shape,
+                                             tfnet.meta['inp_size'], self.roi_pad)
+        return [frame[y1:y2, x1:x2] for frame in frames for (x1, y1, x2, y2) in self.windows]
+
+    def count_per_line(self, index, msec, frame, bboxes, render, frames=1):
+        intersectig_bboxes = self.lines_index.filter(bboxes)
         total = 0
         for i,intersection in enumerate(intersectig_bboxes):
-
-            # separated = separate_bbox_by_class(intersection, classes)
-
-            boxes = non_max_suppression_fast(intersection)
-            # for k in range(len(separated)):
-            #     # boxes += non_max_suppression_fast(separated[k])
-
-            objs = trackers[i].update(convert_bboxes_format(boxes))
-            total += trackers[i].nextObjectID
-
-            draw_bboxes(frame, boxes, colors)
+            boxes = bboxes[intersection]
+
+            first_id = self.trackers[i].nextObjectID
+            objs = self.trackers[i].update(convert_bboxes_format(boxes), boxes[:, 5], frames)
+            total += self.trackers[i].nextObjectID
+            if self.events is not None and self.trackers[i].nextObjectID > first_id:
+                self.log_new_objects(i, index, msec, first_id)
+
+            if render:
+                draw_bboxes(frame, boxes, colors, tfnet.meta['labels'])
+                draw_centroid(frame, objs)
+
+        return total
+
+    def count_global(self, index, msec, frame, bboxes, render, frames=1):
+        # every box is tracked so a track exists before it reaches a line
+        boxes = bboxes
+        tracker = self.trackers[0]
+        objs = tracker.update(convert_bboxes_format(boxes), boxes[:, 5], frames)
+        ids, starts, ends, class_ids = tracker.motion()
+
+        labels = tfnet.meta['labels']
+        crossed = does_segments_cross(starts.astype(np.float32), ends.astype(np.float32),
+                                      self.lines_segments)
+        for t, line in zip(*np.nonzero(crossed)):
+            key = (int(ids[t]), int(line))
+            if key in self.counted:
+                continue
+            self.counted.add(key)
+            self.crossings[line] += 1
+            if self.events is not None:
+                label = labels[class_ids[t]] if class_ids[t] >= 0 else None
+                self.events.add(index, msec, line, label, ids[t])
+
+        if render:
+            draw_bboxes(frame, boxes, colors, labels)
             draw_centroid(frame, objs)
 
-        draw_notification_board(frame, ground_truth, total)
-
-        video_writer.write(frame)
-        t += 1
-        if t >= fps:
-            print("total, ", total)
-            t = 0
-
+        return int(self.crossings.sum())
+
+    def forget_counted(self):
+        # drop the counted pairs of the tracks that are gone
+        alive = set(self.trackers[0].objects)
+        self.counted = set(key for key in self.counted if key[0] in alive)
+
+    def process(self, index, msec, frame, bboxes):
+        # frames skipped by the reader plus this one, the trackers count
+        # them as missed frames of the objects left unmatched
+        frames = index - self.last_index
+        if self.use_kalman:
+            for _ in range(frames):
+                for tracker in self.trackers:
+                    tracker.predict()
+        self.last_index = index
+
+        if self.events is not None:
+            self.events.tick(msec)
+
+        render = self.video_writer is not None and self.processed % self.render_every == 0
+        self.processed += 1
+        if render:
+            draw_lines(frame, self.lines)
+
+        if self.tracking == "global":
+            total = self.count_global(index, msec, frame, bboxes, render, frames)
+        else:
+            total = self.count_per_line(index, msec, frame, bboxes, render, frames)
+        self.total = total
+
+        if self.stride == "auto":
+            self.strides.put(adaptive_stride(self.trackers, self.max_stride, self.max_step))
+
+        if render:
+            draw_notification_board(frame, self.ground_truth, total)
+            repeats = 1
+            if self.stride == "auto":
+                repeats = max(1, int(round((index - self.last_rendered) / float(self.render_every))))
+            self.last_rendered = index
+            for _ in range(repeats):
+                self.write_queue.put(frame)
+        if (index + 1) // self.fps > self.seconds:
+            self.seconds = (index + 1) // self.fps
+            if self.tracking == "global":
+                self.forget_counted()
+            if self.checkpoint and self.seconds % self.checkpoint_every == 0:
+                self.save_checkpoint()
+            if self.name is None:
+                print("total, ", total)
+            else:
+                print(self.name, "total, ", total)
+
+def forward_streams(streams, batches):
+    # one shared sess.run for the frames (or line crops) of every stream
+    inputs = []
+    for stream, batch in zip(streams, batches):
+        frames = [frame for _, _, frame in batch]
+        inputs += frames if stream.roi_pad is None else stream.crops(frames)
+    outputs = get_frames_bboxes(tfnet, inputs)
+
+    results = []
+    start = 0
+    for stream, batch in zip(streams, batches):
+        if stream.roi_pad is None:
+            results.append(outputs[start:start + len(batch)])
+            start += len(batch)
+            continue
+
+        # move the boxes of each crop back to frame coordinates
+        frames_bboxes = []
+        for _ in batch:
+            bboxes = []
+            for (x1, y1, _, _) in stream.windows:
+                crop_bboxes = outputs[start]
+                crop_bboxes[:, :4] += (x1, y1, x1, y1)
+                bboxes.append(crop_bboxes)
+                start += 1
+            if not bboxes:
+                frames_bboxes.append(np.empty((0, 6), np.float32))
+                continue
+            # TFNet already ran NMS inside each crop, only the duplicates
+            # of windows that overlap are left to merge
+            frames_bboxes.append(non_max_suppression_fast(np.concatenate(bboxes),
+                                                          overlapThresh=tfnet.FLAGS.nms,
+                                                          classAware=stream.class_aware_nms))
+        results.append(frames_bboxes)
+
+    return results
+
+def compute_videos(streams, batch_size=1, queue_size=8):
+    # every stream gets its own reader and writer threads while a single
+    # TFNet serves all of them: each round takes up to batch_size frames
+    # from every stream still running, round-robin, and forwards them together
+    stop = threading.Event()
+    for stream in streams:
+        stream.start(stop, batch_size, queue_size)
+
+    try:
+        while True:
+            active = [stream for stream in streams if not stream.done]
+            if not active:
+                break
+
+            batches = []
+            for stream in active:
+                batch, stream.done = read_batch(stream.read_queue, batch_size)
+                batches.append(batch)
+
+            for stream, batch, frames_bboxes in zip(active, batches,
+                                                     forward_streams(active, batches)):
+                for (index, msec, frame), bboxes in zip(batch, frames_bboxes):
+                    stream.process(index, msec, frame, bboxes)
+    finally:
+        stop.set()
+        for stream in streams:
+            stream.stop()
+
+def compute_video(cap, lines, video_writer, ground_truth, batch_size=1,
+        stride=1, max_stride=8, max_step=16.0, roi_pad=None, queue_size=8):
+    stream = VideoStream(cap, lines, video_writer, ground_truth, stride=stride,
+                         max_stride=max_stride, max_step=max_step, roi_pad=roi_pad)
+    compute_videos([stream], batch_size=batch_size, queue_size=queue_size)
+
+def load_jobs(file_name):
+    jobs_file = open(file_name, "r")
+    jobs = json.loads(jobs_file.read())['jobs']
+    jobs_file.close()
+    return jobs
+
+def open_stream(job, args):
+    cap = cv2.VideoCapture(job['video'])
+
+    video_writer = None
+    if not args.count_only and job.get('output'):
+        fourcc = cv2.VideoWriter_fourcc('M','J','P','G')
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        # one frame is written every preview keyframes; a fixed stride
+        # spaces the keyframes by stride frames, with --stride auto each
+        # written frame is repeated over the frames it stands for
+        fps = cap.get(cv2.CAP_PROP_FPS) / args.preview
+        if args.stride != "auto":
+            fps /= int(args.stride)
+        video_writer = cv2.VideoWriter(job['output'], fourcc, fps, (width, height))
+    lines = load_lines(job['lines'])
+
+    stride = args.stride if args.stride == "auto" else int(args.stride)
+    return VideoStream(cap, lines, video_writer, job.get('ground_truth', 0),
+                       name=job.get('name'), stride=stride, max_stride=args.max_stride,
+                       max_step=args.max_step, roi_pad=args.roi_pad, render_every=args.preview,
+                       events=job.get('events'), assignment=args.assignment,
+                       max_distance=args.max_distance, tracking=args.tracking,
+                       checkpoint=job.get('checkpoint'), checkpoint_every=args.checkpoint_every,
+                       class_aware_nms=args.class_aware_nms)
 
 
 if __name__ == "__main__":
@@ -191,19 +664,65 @@ if __name__ == "__main__":
     colors['truck'] = (6, 37, 82)
     colors['bus'] = (2, 106, 253)
 
-    options = {"pbLoad": sys.argv[1], "metaLoad": sys.argv[2], "threshold": 0.3, "gpu": 1.0}
+    parser = argparse.ArgumentParser(description="Count vehicles crossing the lines of a video")
+    parser.add_argument("pb", help="path to the .pb graph")
+    parser.add_argument("meta", help="path to the .meta file of the graph")
+    parser.add_argument("video", nargs="?", help="input video")
+    parser.add_argument("output", nargs="?", help="output video (MJPG); with --count-only it may be '-', or omitted when ground_truth is too")
+    parser.add_argument("lines", nargs="?", help="json file with the counting lines")
+    parser.add_argument("ground_truth", nargs="?", type=int, default=0, help="ground truth count shown on the output video")
+    parser.add_argument("--jobs", help="json file with a list of {video, output, lines, ground_truth, name, events, checkpoint} jobs sharing one TFNet")
+    parser.add_argument("--batch-size", type=int, default=1, help="frames of each stream forwarded per sess.run")
+    parser.add_argument("--stride", default="1", help="run the detector every N frames, or 'auto' to adapt N to the track speeds")
+    parser.add_argument("--max-stride", type=int, default=8, help="largest stride used by --stride auto")
+    parser.add_argument("--max-step", type=float, default=16.0, help="pixels a track may move between detections with --stride auto")
+    parser.add_argument("--nms", type=float, default=0.35, help="IoU threshold of the non-maximum suppression")
+    parser.add_argument("--nms-top-k", type=int, default=200, help="only the best N candidates of a frame enter the non-maximum suppression, 0 for all")
+    parser.add_argument("--class-aware-nms", action="store_true", help="only suppress overlapping boxes of the same class")
+    parser.add_argument("--keep-labels", default="car,bus,truck,motorcycle", help="comma separated labels to detect")
+    parser.add_argument("--max-det", type=int, default=0, help="keep at most this many detections per frame, 0 for no limit")
+    parser.add_argument("--tracking", choices=["per-line", "global"], default="per-line", help="one tracker per line counting new objects, or one tracker per frame counting line crossings")
+    parser.add_argument("--assignment", choices=["greedy", "gated"], default="greedy", help="tracker matching: greedy over all pairs, or optimal over the pairs closer than --max-distance")
+    parser.add_argument("--max-distance", type=float, default=50.0, help="gate in pixels of --assignment gated")
+    parser.add_argument("--events", help="log every counted vehicle to this .jsonl or .csv file, with per-second counts next to it")
+    parser.add_argument("--checkpoint", help="save the counting state to this .npz file and resume from it when it exists")
+    parser.add_argument("--checkpoint-every", type=int, default=60, help="seconds of video between checkpoints")
+    parser.add_argument("--count-only", action="store_true", help="only count: draw nothing and write no output video")
+    parser.add_argument("--preview", type=int, default=1, help="render and write only every Kth processed frame to the output video")
+    parser.add_argument("--roi-pad", type=int, default=None, help="run the detector only on windows padded by this many pixels around each line")
+    args = parser.parse_args()
+
+    if args.preview < 1:
+        parser.error("--preview must be at least 1")
+    if args.count_only and args.output is not None and args.lines is None:
+        # "video lines --count-only": the output was left out
+        args.output, args.lines = None, args.output
+    if args.output == "-":
+        args.output = None
+
+    if args.jobs:
+        jobs = load_jobs(args.jobs)
+        for job in jobs:
+            job.setdefault('name', job['video'])
+    elif args.video and args.lines and (args.output or args.count_only):
+        jobs = [{"video": args.video, "output": args.output, "lines": args.lines,
+                 "ground_truth": args.ground_truth, "events": args.events,
+                 "checkpoint": args.checkpoint}]
+    else:
+        parser.error("either video, output (optional with --count-only), lines or --jobs are required")
+
+    # single post-processing stage, run by TFNet on each frame: threshold,
+    # class filter, NMS and detection cap
+    options = {"pbLoad": args.pb, "metaLoad": args.meta, "threshold": 0.3, "gpu": 1.0,
+               "nms": args.nms, "nmsAgnostic": not args.class_aware_nms, "nmsTopK": args.nms_top_k,
+               "keepLabels": args.keep_labels, "maxDet": args.max_det}
     tfnet = TFNet(options)
 
-    cap = cv2.VideoCapture(sys.argv[3])
-    fourcc = cv2.VideoWriter_fourcc('M','J','P','G')
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-
-    video_writer = cv2.VideoWriter(sys.argv[4], fourcc, fps, (width, height))
-    lines = load_lines(sys.argv[5])
+    streams = [open_stream(job, args) for job in jobs]
 
-    compute_video(cap, lines, video_writer, int(sys.argv[6]))
+    compute_videos(streams, batch_size=args.batch_size)
 
-    cap.release()
-    video_writer.release()
+    for stream in streams:
+        stream.cap.release()
+        if stream.video_writer is not None:
+            stream.video_writer.release()
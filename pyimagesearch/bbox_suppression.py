@@ -1,70 +1,53 @@
 # import the necessary packages
 import numpy as np
 
+def pairwise_iou(x1, y1, x2, y2):
+    # (N, N) intersection over union of every pair of boxes
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    w = np.maximum(0, np.minimum(x2[:, None], x2[None, :]) -
+                      np.maximum(x1[:, None], x1[None, :]) + 1)
+    h = np.maximum(0, np.minimum(y2[:, None], y2[None, :]) -
+                      np.maximum(y1[:, None], y1[None, :]) + 1)
+    inter = w * h
+    return inter / (area[:, None] + area[None, :] - inter)
+
 # Malisiewicz et al.
-def non_max_suppression_fast(boxes, overlapThresh=0.35):
-    # if there are no boxes, return an empty list
+def non_max_suppression_fast(boxes, overlapThresh=0.35, classAware=False, topK=None):
+    # if there are no boxes, return them as they are
     if len(boxes) == 0:
-        return []
-
-
-    # initialize the list of picked indexes
+        return boxes
+
+    # grab the coordinates of the (N, 6) rows of
+    # x1, y1, x2, y2, confidence, class_id
+    x1 = boxes[:, 0].astype("float")
+    y1 = boxes[:, 1].astype("float")
+    x2 = boxes[:, 2].astype("float")
+    y2 = boxes[:, 3].astype("float")
+
+    # with classAware, boxes of different classes are moved apart by a
+    # per-class offset so they never overlap and all classes are still
+    # suppressed in a single pass
+    if classAware:
+        offset = boxes[:, 5] * (max(x2.max(), y2.max()) + 2)
+        x1, y1, x2, y2 = x1 + offset, y1 + offset, x2 + offset, y2 + offset
+
+    # compute the overlap of every pair of boxes once and visit the
+    # boxes by decreasing confidence
+    overlap = pairwise_iou(x1, y1, x2, y2) > overlapThresh
+    idxs = np.argsort(-boxes[:, 4], kind="stable")
+
+    # a box is kept unless a box kept before it overlaps it; suppressed
+    # boxes are flagged in a mask instead of being deleted from the
+    # index array
+    suppressed = np.zeros(len(boxes), dtype="bool")
     pick = []
-
-    x1 = []
-    y1 = []
-    x2 = []
-    y2 = []
-
-    confidence = []
-
-    for box in boxes:
-        x1.append(box["topleft"]['x'])
-        y1.append(box["topleft"]['y'])
-        x2.append(box["bottomright"]['x'])
-        y2.append(box["bottomright"]['y'])
-        confidence.append(box["confidence"])
-
-
-    # grab the coordinates of the bounding boxes
-    x1 = np.asarray(x1).astype("float")
-    y1 = np.asarray(y1).astype("float")
-    x2 = np.asarray(x2).astype("float")
-    y2 = np.asarray(y2).astype("float")
-
-    # compute the area of the bounding boxes and sort the bounding
-    # boxes by the bottom-right y-coordinate of the bounding box
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    idxs = np.argsort(np.asarray(confidence))
-
-    # keep looping while some indexes still remain in the indexes
-    # list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the
-        # index value to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
+    for i in idxs:
+        if suppressed[i]:
+            continue
         pick.append(i)
+        if topK is not None and len(pick) >= topK:
+            break
+        suppressed |= overlap[i]
 
-        # find the largest (x, y) coordinates for the start of
-        # the bounding box and the smallest (x, y) coordinates
-        # for the end of the bounding box
-        xx1 = np.maximum(x1[i], x1[idxs[:last]])
-        yy1 = np.maximum(y1[i], y1[idxs[:last]])
-        xx2 = np.minimum(x2[i], x2[idxs[:last]])
-        yy2 = np.minimum(y2[i], y2[idxs[:last]])
-
-        # compute the width and height of the bounding box
-        w = np.maximum(0, xx2 - xx1 + 1)
-        h = np.maximum(0, yy2 - yy1 + 1)
-
-        # compute the ratio of overlap
-        overlap = (w * h) / area[idxs[:last]]
-
-        # delete all indexes from the index list that have
-        idxs = np.delete(idxs, np.concatenate(([last],
-            np.where(overlap > overlapThresh)[0]) ) )
-
-    # return only the bounding boxes that were picked using the
-    # integer data type
-    return [boxes[i] for i in pick]
+    # return only the bounding boxes that were picked
+    return boxes[pick]
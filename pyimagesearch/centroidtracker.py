@@ -1,84 +1,396 @@
 # import the necessary packages
 from scipy.spatial import distance as dist
-from collections import OrderedDict
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from collections.abc import Mapping
 import numpy as np
 
+# constant-velocity motion model of the optional Kalman prediction,
+# state is (x, y, vx, vy) and only (x, y) is measured
+KF_F = np.array([[1, 0, 1, 0],
+	[0, 1, 0, 1],
+	[0, 0, 1, 0],
+	[0, 0, 0, 1]], dtype="float")
+KF_H = np.eye(2, 4)
+
+def gated_assignment(objectCentroids, inputCentroids, maxDistance):
+	# optimal (minimum total distance) matching restricted to the pairs
+	# closer than maxDistance: the candidate pairs come from a KD-tree
+	# radius query and the Hungarian algorithm only runs inside each
+	# connected group of candidates, so dense scenes stay close to linear
+	objectTree = cKDTree(objectCentroids)
+	inputTree = cKDTree(inputCentroids)
+	pairs = objectTree.sparse_distance_matrix(inputTree, maxDistance,
+		output_type="ndarray")
+	if len(pairs) == 0:
+		return np.empty(0, dtype="int"), np.empty(0, dtype="int")
+
+	# label the groups of the bipartite graph of candidate pairs, rows
+	# are nodes 0..N-1 and columns nodes N..N+M-1
+	N, M = len(objectCentroids), len(inputCentroids)
+	graph = coo_matrix((np.ones(len(pairs)), (pairs["i"], N + pairs["j"])),
+		shape=(N + M, N + M))
+	_, labels = connected_components(graph, directed=False)
+	edgeLabels = labels[pairs["i"]]
+
+	# the groups made of a single candidate pair need no solving and are
+	# accepted all at once
+	edgeCounts = np.bincount(edgeLabels)
+	single = edgeCounts[edgeLabels] == 1
+	matchedRows = [pairs["i"][single]]
+	matchedCols = [pairs["j"][single]]
+
+	multi = np.flatnonzero(~single)
+	order = multi[np.argsort(edgeLabels[multi], kind="stable")]
+	bounds = np.flatnonzero(np.diff(edgeLabels[order])) + 1
+	for group in np.split(order, bounds) if len(order) else []:
+		rows, rowIdx = np.unique(pairs["i"][group], return_inverse=True)
+		cols, colIdx = np.unique(pairs["j"][group], return_inverse=True)
+
+		# pairs outside the gate cost more than any gated solution
+		cost = np.full((len(rows), len(cols)), maxDistance * (len(group) + 1))
+		cost[rowIdx, colIdx] = pairs["v"][group]
+		r, c = linear_sum_assignment(cost)
+		gated = cost[r, c] <= maxDistance
+		matchedRows.append(rows[r[gated]])
+		matchedCols.append(cols[c[gated]])
+
+	return np.concatenate(matchedRows), np.concatenate(matchedCols)
+
+class TrackedObjects(Mapping):
+	# read-only object ID -> centroid view over the tracker arrays,
+	# returned by update() in place of the old OrderedDict
+	__slots__ = ("tracker",)
+
+	def __init__(self, tracker):
+		self.tracker = tracker
+
+	def __len__(self):
+		return int(self.tracker.active.sum())
+
+	def __iter__(self):
+		slots = self.tracker.activeSlots()
+		return iter(self.tracker.ids[slots].tolist())
+
+	def __getitem__(self, objectID):
+		slot = self.tracker.slotOf(objectID)
+		if slot is None:
+			raise KeyError(objectID)
+		return self.tracker.centroids[slot]
+
+	def items(self):
+		slots = self.tracker.activeSlots()
+		return list(zip(self.tracker.ids[slots].tolist(),
+			self.tracker.centroids[slots]))
+
+	def values(self):
+		return list(self.tracker.centroids[self.tracker.activeSlots()])
+
 class CentroidTracker():
-	def __init__(self, maxDisappeared=50):
-		# initialize the next unique object ID along with two ordered
-		# dictionaries used to keep track of mapping a given object
-		# ID to its centroid and number of consecutive frames it has
-		# been marked as "disappeared", respectively
+	# all per-object state lives in preallocated arrays indexed by slot;
+	# a deregistered object frees its slot for the next registration
+	__slots__ = ("nextObjectID", "maxDisappeared", "kalman", "Q", "R",
+		"assignment", "maxDistance",
+		"ids", "active", "centroids", "disappeared", "states",
+		"covariances", "freeSlots", "objects", "previous", "measured",
+		"classIds", "moved", "historySize", "history", "historyHead",
+		"historyLength")
+
+	# per-slot arrays saved by snapshot(), in this order
+	STATE = ("ids", "centroids", "disappeared", "states", "covariances",
+		"previous", "measured", "classIds", "moved", "history",
+		"historyHead", "historyLength")
+
+	def __init__(self, maxDisappeared=50, kalman=False, processNoise=1.0,
+		measurementNoise=4.0, capacity=64, assignment="greedy", maxDistance=50.0,
+		historySize=32):
+		# initialize the next unique object ID along with the slot
+		# arrays used to keep track of each object ID, its centroid
+		# and number of consecutive frames it has been marked as
+		# "disappeared", respectively
 		self.nextObjectID = 0
-		self.objects = OrderedDict()
-		self.disappeared = OrderedDict()
+		self.ids = np.full(capacity, -1, dtype="int64")
+		self.active = np.zeros(capacity, dtype="bool")
+		self.centroids = np.zeros((capacity, 2), dtype="int64")
+		self.disappeared = np.zeros(capacity, dtype="int64")
+		self.freeSlots = list(range(capacity - 1, -1, -1))
+		self.objects = TrackedObjects(self)
+
+		# the last two measured centroids of each object, its class
+		# and whether the last update matched it, so callers can test
+		# the motion of every object against their lines at once
+		self.previous = np.zeros((capacity, 2), dtype="int64")
+		self.measured = np.zeros((capacity, 2), dtype="int64")
+		self.classIds = np.full(capacity, -1, dtype="int64")
+		self.moved = np.zeros(capacity, dtype="bool")
+
+		# fixed-size ring buffer with the last historySize measured
+		# centroids of each object, historyHead is the next position
+		# to write and historyLength how many are filled
+		self.historySize = historySize
+		self.history = np.zeros((capacity, historySize, 2), dtype="int64")
+		self.historyHead = np.zeros(capacity, dtype="int64")
+		self.historyLength = np.zeros(capacity, dtype="int64")
 
 		# store the number of maximum consecutive frames a given
 		# object is allowed to be marked as "disappeared" until we
 		# need to deregister the object from tracking
 		self.maxDisappeared = maxDisappeared
 
-	def register(self, centroid):
+		# "greedy" matches objects to inputs by sorted row minima over
+		# the full distance matrix; "gated" only considers pairs closer
+		# than maxDistance and solves them optimally
+		self.assignment = assignment
+		self.maxDistance = maxDistance
+
+		# when enabled, each object also carries a Kalman state and
+		# covariance so predict() can move it between detections
+		self.kalman = kalman
+		self.states = np.zeros((capacity, 4), dtype="float")
+		self.covariances = np.zeros((capacity, 4, 4), dtype="float")
+		self.Q = processNoise * np.diag([0.25, 0.25, 1.0, 1.0])
+		self.R = measurementNoise * np.eye(2)
+
+	def grow(self):
+		# double the capacity of every slot array
+		capacity = len(self.ids)
+		self.ids = np.concatenate((self.ids, np.full(capacity, -1, dtype="int64")))
+		self.active = np.concatenate((self.active, np.zeros(capacity, dtype="bool")))
+		self.centroids = np.concatenate((self.centroids, np.zeros_like(self.centroids)))
+		self.disappeared = np.concatenate((self.disappeared, np.zeros_like(self.disappeared)))
+		self.states = np.concatenate((self.states, np.zeros_like(self.states)))
+		self.covariances = np.concatenate((self.covariances, np.zeros_like(self.covariances)))
+		self.previous = np.concatenate((self.previous, np.zeros_like(self.previous)))
+		self.measured = np.concatenate((self.measured, np.zeros_like(self.measured)))
+		self.classIds = np.concatenate((self.classIds, np.full(capacity, -1, dtype="int64")))
+		self.moved = np.concatenate((self.moved, np.zeros(capacity, dtype="bool")))
+		self.history = np.concatenate((self.history, np.zeros_like(self.history)))
+		self.historyHead = np.concatenate((self.historyHead, np.zeros_like(self.historyHead)))
+		self.historyLength = np.concatenate((self.historyLength, np.zeros_like(self.historyLength)))
+		self.freeSlots = list(range(2 * capacity - 1, capacity - 1, -1))
+
+	def activeSlots(self):
+		# slots of the tracked objects, in registration (object ID) order
+		slots = np.flatnonzero(self.active)
+		return slots[np.argsort(self.ids[slots], kind="stable")]
+
+	def slotOf(self, objectID):
+		slots = np.flatnonzero(self.active & (self.ids == objectID))
+		return slots[0] if len(slots) else None
+
+	def register(self, centroid, classId=-1):
 		# when registering an object we use the next available object
-		# ID to store the centroid
-		self.objects[self.nextObjectID] = centroid
-		self.disappeared[self.nextObjectID] = 0
+		# ID and the next free slot to store the centroid
+		if not self.freeSlots:
+			self.grow()
+		slot = self.freeSlots.pop()
+		self.ids[slot] = self.nextObjectID
+		self.active[slot] = True
+		self.centroids[slot] = centroid
+		self.disappeared[slot] = 0
+		self.previous[slot] = centroid
+		self.measured[slot] = centroid
+		self.classIds[slot] = classId
+		self.historyHead[slot] = 0
+		self.historyLength[slot] = 0
+		self.remember(np.array([slot]), np.asarray(centroid)[None])
+		if self.kalman:
+			# the velocity is unknown until the second measurement
+			self.states[slot] = (centroid[0], centroid[1], 0.0, 0.0)
+			self.covariances[slot] = np.diag(
+				[self.R[0, 0], self.R[1, 1], 100.0, 100.0])
 		self.nextObjectID += 1
 
+	def release(self, slot):
+		self.active[slot] = False
+		self.ids[slot] = -1
+		self.freeSlots.append(slot)
+
 	def deregister(self, objectID):
-		# to deregister an object ID we delete the object ID from
-		# both of our respective dictionaries
-		del self.objects[objectID]
-		del self.disappeared[objectID]
+		# to deregister an object ID we free its slot
+		slot = self.slotOf(objectID)
+		if slot is not None:
+			self.release(slot)
+
+	def markDisappeared(self, slots, frames=1):
+		# add the frames elapsed since the last update to the
+		# disappeared counter of the given slots and deregister the
+		# objects missing for too long
+		self.disappeared[slots] += frames
+		for slot in slots[self.disappeared[slots] > self.maxDisappeared]:
+			self.release(slot)
+
+	def predict(self):
+		# advance every object one frame with the constant-velocity
+		# model, without touching the disappeared counters; used on
+		# the frames where no detection is run
+		slots = np.flatnonzero(self.active)
+		states = self.states[slots].dot(KF_F.T)
+		self.states[slots] = states
+		self.covariances[slots] = np.einsum("ij,njk,lk->nil",
+			KF_F, self.covariances[slots], KF_F) + self.Q
+		self.centroids[slots] = states[:, :2].astype("int")
+
+		return self.objects
+
+	def correct(self, slots, centroids):
+		# fold the matched measurements into the Kalman states, all
+		# slots at once (H only selects x and y)
+		states = self.states[slots]
+		P = self.covariances[slots]
+		S = P[:, :2, :2] + self.R
+		K = np.matmul(P[:, :, :2], np.linalg.inv(S))
+		innovation = centroids - states[:, :2]
+		self.states[slots] = states + np.einsum("nij,nj->ni", K, innovation)
+		self.covariances[slots] = P - np.matmul(K, P[:, :2, :])
+
+	def maxSpeed(self):
+		# largest estimated speed in pixels per frame, 0 when there is
+		# no object (or no velocity estimate) yet
+		if not self.kalman or not self.active.any():
+			return 0.0
+		velocities = self.states[self.active, 2:]
+		return float(np.sqrt((velocities ** 2).sum(axis=1)).max())
+
+	def matched(self, slots, centroids, classIds):
+		# set the new centroids of the matched objects and reset
+		# their disappeared counters
+		self.centroids[slots] = centroids
+		self.disappeared[slots] = 0
+		self.previous[slots] = self.measured[slots]
+		self.measured[slots] = centroids
+		self.classIds[slots] = classIds
+		self.moved[slots] = True
+		self.remember(slots, centroids)
+		if self.kalman:
+			self.correct(slots, centroids)
+
+	def remember(self, slots, centroids):
+		# push the centroids into the history ring buffers
+		self.history[slots, self.historyHead[slots]] = centroids
+		self.historyHead[slots] = (self.historyHead[slots] + 1) % self.historySize
+		self.historyLength[slots] = np.minimum(self.historyLength[slots] + 1,
+			self.historySize)
+
+	def track(self, objectID):
+		# measured centroids of an object, oldest first, to derive its
+		# speed or direction
+		slot = self.slotOf(objectID)
+		if slot is None:
+			raise KeyError(objectID)
+		length = self.historyLength[slot]
+		order = (self.historyHead[slot] - length + np.arange(length)) % self.historySize
+		return self.history[slot, order]
+
+	def state(self):
+		# the whole tracker state as a dict of arrays, holding the
+		# tracked objects only
+		slots = self.activeSlots()
+		state = dict((name, getattr(self, name)[slots]) for name in self.STATE)
+		state["nextObjectID"] = np.array(self.nextObjectID)
+		return state
+
+	def setState(self, state):
+		# inverse of state(): the objects go back to the first slots
+		count = len(state["ids"])
+		capacity = max(64, 2 * count)
+		self.historySize = state["history"].shape[1]
+		for name in self.STATE:
+			values = np.asarray(state[name])
+			array = np.zeros((capacity,) + values.shape[1:], dtype=values.dtype)
+			array[:count] = values
+			setattr(self, name, array)
+		self.ids[count:] = -1
+		self.classIds[count:] = -1
+		self.active = np.zeros(capacity, dtype="bool")
+		self.active[:count] = True
+		self.freeSlots = list(range(capacity - 1, count - 1, -1))
+		self.nextObjectID = int(state["nextObjectID"])
+
+	def snapshot(self, file):
+		# serialize the tracker state to a compressed .npz file (a path
+		# or a file object), see restore()
+		np.savez_compressed(file, **self.state())
+
+	def restore(self, file):
+		with np.load(file) as state:
+			self.setState(state)
+
+	def motion(self):
+		# object IDs, previous and current measured centroids and
+		# classes of the objects matched by the last update
+		slots = np.flatnonzero(self.moved)
+		return (self.ids[slots], self.previous[slots],
+			self.measured[slots], self.classIds[slots])
+
+	def gatedUpdate(self, objectSlots, inputCentroids, inputClasses, frames=1):
+		rows, cols = gated_assignment(self.centroids[objectSlots],
+			inputCentroids, self.maxDistance)
+		self.matched(objectSlots[rows], inputCentroids[cols], inputClasses[cols])
+
+		# unlike the greedy matching, both sides can be left over: the
+		# objects with no input inside the gate are marked disappeared
+		# and the inputs with no object are registered
+		usedRows = np.zeros(len(objectSlots), dtype="bool")
+		usedCols = np.zeros(len(inputCentroids), dtype="bool")
+		usedRows[rows] = True
+		usedCols[cols] = True
+		self.markDisappeared(objectSlots[~usedRows], frames)
+		for col in np.flatnonzero(~usedCols):
+			self.register(inputCentroids[col], inputClasses[col])
+
+	def update(self, rects, classIds=None, frames=1):
+		# classIds optionally gives the class of each rectangle, kept
+		# with the object it is matched to; frames is the number of
+		# frames since the previous update (the detection stride), so
+		# maxDisappeared stays a number of frames
+		self.moved[:] = False
 
-	def update(self, rects):
 		# check to see if the list of input bounding box rectangles
 		# is empty
 		if len(rects) == 0:
-			# loop over any existing tracked objects and mark them
-			# as disappeared
-			for objectID in list(self.disappeared.keys()):
-				self.disappeared[objectID] += 1
-
-				# if we have reached a maximum number of consecutive
-				# frames where a given object has been marked as
-				# missing, deregister it
-				if self.disappeared[objectID] > self.maxDisappeared:
-					self.deregister(objectID)
+			# mark every existing tracked object as disappeared,
+			# deregistering the ones that reached the maximum number
+			# of consecutive missing frames
+			self.markDisappeared(np.flatnonzero(self.active), frames)
 
 			# return early as there are no centroids or tracking info
 			# to update
 			return self.objects
 
-		# initialize an array of input centroids for the current frame
-		inputCentroids = np.zeros((len(rects), 2), dtype="int")
-
-		# loop over the bounding box rectangles
-		for (i, (startX, startY, endX, endY)) in enumerate(rects):
-			# use the bounding box coordinates to derive the centroid
-			cX = int((startX + endX) / 2.0)
-			cY = int((startY + endY) / 2.0)
-			inputCentroids[i] = (cX, cY)
+		# derive the input centroids for the current frame from all
+		# the bounding box rectangles at once
+		rects = np.asarray(rects)
+		inputCentroids = ((rects[:, 0:2] + rects[:, 2:4]) / 2.0).astype("int")
+		if classIds is None:
+			inputClasses = np.full(len(rects), -1, dtype="int64")
+		else:
+			inputClasses = np.asarray(classIds).astype("int64")
 
 		# if we are currently not tracking any objects take the input
 		# centroids and register each of them
-		if len(self.objects) == 0:
+		if not self.active.any():
 			for i in range(0, len(inputCentroids)):
-				self.register(inputCentroids[i])
+				self.register(inputCentroids[i], inputClasses[i])
 
 		# otherwise, are are currently tracking objects so we need to
 		# try to match the input centroids to existing object
 		# centroids
 		else:
-			# grab the set of object IDs and corresponding centroids
-			objectIDs = list(self.objects.keys())
-			objectCentroids = list(self.objects.values())
+			# grab the slots of the tracked objects, in ID order
+			objectSlots = self.activeSlots()
+
+			if self.assignment == "gated":
+				self.gatedUpdate(objectSlots, inputCentroids, inputClasses, frames)
+				return self.objects
 
 			# compute the distance between each pair of object
 			# centroids and input centroids, respectively -- our
 			# goal will be to match an input centroid to an existing
 			# object centroid
-			D = dist.cdist(np.array(objectCentroids), inputCentroids)
+			D = dist.cdist(self.centroids[objectSlots], inputCentroids)
 
 			# in order to perform this matching we must (1) find the
 			# smallest value in each row and then (2) sort the row
@@ -95,59 +407,38 @@ class CentroidTracker():
 			# in order to determine if we need to update, register,
 			# or deregister an object we need to keep track of which
 			# of the rows and column indexes we have already examined
-			usedRows = set()
-			usedCols = set()
+			usedRows = np.zeros(D.shape[0], dtype="bool")
+			usedCols = np.zeros(D.shape[1], dtype="bool")
 
 			# loop over the combination of the (row, column) index
-			# tuples
+			# tuples, keeping the first pair found for each of them
 			for (row, col) in zip(rows, cols):
-				# if we have already examined either the row or
-				# column value before, ignore it
-				# val
-				if row in usedRows or col in usedCols:
+				if usedRows[row] or usedCols[col]:
 					continue
+				usedRows[row] = True
+				usedCols[col] = True
 
-				# otherwise, grab the object ID for the current row,
-				# set its new centroid, and reset the disappeared
-				# counter
-				objectID = objectIDs[row]
-				self.objects[objectID] = inputCentroids[col]
-				self.disappeared[objectID] = 0
-
-				# indicate that we have examined each of the row and
-				# column indexes, respectively
-				usedRows.add(row)
-				usedCols.add(col)
-
-			# compute both the row and column index we have NOT yet
-			# examined
-			unusedRows = set(range(0, D.shape[0])).difference(usedRows)
-			unusedCols = set(range(0, D.shape[1])).difference(usedCols)
+			# grab the slots and input centroids of the matched pairs,
+			# set their new centroids, and reset the disappeared
+			# counters
+			matchedRows = np.flatnonzero(usedRows)
+			matchedCols = D[matchedRows].argmin(axis=1)
+			self.matched(objectSlots[matchedRows],
+				inputCentroids[matchedCols], inputClasses[matchedCols])
 
 			# in the event that the number of object centroids is
 			# equal or greater than the number of input centroids
 			# we need to check and see if some of these objects have
 			# potentially disappeared
 			if D.shape[0] >= D.shape[1]:
-				# loop over the unused row indexes
-				for row in unusedRows:
-					# grab the object ID for the corresponding row
-					# index and increment the disappeared counter
-					objectID = objectIDs[row]
-					self.disappeared[objectID] += 1
-
-					# check to see if the number of consecutive
-					# frames the object has been marked "disappeared"
-					# for warrants deregistering the object
-					if self.disappeared[objectID] > self.maxDisappeared:
-						self.deregister(objectID)
+				self.markDisappeared(objectSlots[~usedRows], frames)
 
 			# otherwise, if the number of input centroids is greater
 			# than the number of existing object centroids we need to
 			# register each new input centroid as a trackable object
 			else:
-				for col in unusedCols:
-					self.register(inputCentroids[col])
+				for col in np.flatnonzero(~usedCols):
+					self.register(inputCentroids[col], inputClasses[col])
 
 		# return the set of trackable objects
 		return self.objects
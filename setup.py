@@ -3,11 +3,21 @@ from setuptools.extension import Extension
 from Cython.Build import cythonize
 import numpy
 import os
+import sys
 import imp
 
 VERSION = imp.load_source('version', os.path.join('.', 'darkflow', 'version.py'))
 VERSION = VERSION.__version__
 
+# the batched box decoder runs its images in parallel with OpenMP,
+# it still builds (serially) where OpenMP is not available
+if os.name == 'nt':
+    openmp = dict(extra_compile_args=['/openmp'])
+elif sys.platform == 'darwin':
+    openmp = dict()
+else:
+    openmp = dict(extra_compile_args=['-fopenmp'], extra_link_args=['-fopenmp'])
+
 if os.name =='nt' :
     ext_modules=[
         Extension("darkflow.cython_utils.nms",
@@ -18,7 +28,8 @@ if os.name =='nt' :
         Extension("darkflow.cython_utils.cy_yolo2_findboxes",
             sources=["darkflow/cython_utils/cy_yolo2_findboxes.pyx"],
             #libraries=["m"] # Unix-like specific
-            include_dirs=[numpy.get_include()]
+            include_dirs=[numpy.get_include()],
+            **openmp
         ),
         Extension("darkflow.cython_utils.cy_yolo_findboxes",
             sources=["darkflow/cython_utils/cy_yolo_findboxes.pyx"],
@@ -37,7 +48,8 @@ elif os.name =='posix' :
         Extension("darkflow.cython_utils.cy_yolo2_findboxes",
             sources=["darkflow/cython_utils/cy_yolo2_findboxes.pyx"],
             libraries=["m"], # Unix-like specific
-            include_dirs=[numpy.get_include()]
+            include_dirs=[numpy.get_include()],
+            **openmp
         ),
         Extension("darkflow.cython_utils.cy_yolo_findboxes",
             sources=["darkflow/cython_utils/cy_yolo_findboxes.pyx"],